@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Benchmarks the image optimization pipelines against a deterministic corpus
+of generated images, reporting wall time, CPU time, bytes saved and files
+per second for each pipeline as JSON.
+
+Pipelines whose command line tools aren't installed are reported as
+unavailable rather than run, so the harness works anywhere PIL does.
+"""
+
+import sys, os, os.path, binascii, getopt, hashlib, json, random, shutil, tempfile, time, logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smush.destructo'))
+
+from PIL import Image
+from flask import Flask
+from flask_optimize import Optimize, get_optimizer, which
+from optimiser.formats.png import OptimisePNG
+from optimiser.formats.jpg import OptimiseJPG
+from optimiser.formats.gif import OptimiseGIF
+
+# (name, kind, width, height). Sizes run from ~1KB to ~20MB
+CORPUS = (
+    ('photo-64', 'photo', 64, 48),
+    ('photo-640', 'photo', 640, 480),
+    ('photo-2048', 'photo', 2048, 1536),
+    ('photo-6000', 'photo', 6000, 4000),
+    ('flat-32', 'flat', 32, 32),
+    ('flat-512', 'flat', 512, 512),
+    ('flat-2048', 'flat', 2048, 2048),
+    ('noise-2600', 'noise', 2600, 2600),
+    ('static-gif-256', 'gif', 256, 256),
+    ('animated-gif-128', 'animated', 128, 128),
+    ('animated-gif-512', 'animated', 512, 512),
+)
+
+# pipeline name -> (command line tools, formats it optimizes)
+PIPELINES = {
+    'PNGOptimizer': (('pngnq', 'pngcrush'), ('PNG',)),
+    'JPGOptimizer': (('jpegtran',), ('JPEG',)),
+    'OptimisePNG': (('pngnq', 'pngcrush'), ('PNG',)),
+    'OptimiseJPG': (('jpegtran',), ('JPEG',)),
+    'OptimiseGIF': (('convert', 'pngnq', 'pngcrush', 'gifsicle'), ('GIF',)),
+}
+
+
+def _noise(rand, width, height, mode='RGB'):
+    """
+    Returns an image of seeded random noise
+    """
+    size = width * height * len(mode)
+    data = binascii.unhexlify('%0*x' % (size * 2, rand.getrandbits(size * 8)))
+    return Image.frombytes(mode, (width, height), data)
+
+
+def _photo(rand, width, height):
+    """
+    Returns a photo-like image: smooth colour fields with a fine texture
+    """
+    image = _noise(rand, 8, 6).resize((width, height), Image.BICUBIC)
+    texture = _noise(rand, 64, 64)
+    for x in xrange(0, width, 64):
+        for y in xrange(0, height, 64):
+            region = image.crop((x, y, x + 64, y + 64))
+            image.paste(Image.blend(region, texture, 0.15), (x, y))
+    return image
+
+
+def _flat(rand, width, height):
+    """
+    Returns a flat-colour image of a few rectangles, like a logo or chart
+    """
+    image = Image.new('RGB', (width, height), (255, 255, 255))
+    for i in range(8):
+        x, y = rand.randrange(width), rand.randrange(height)
+        box = (x, y, min(width, x + rand.randrange(1, width)), min(height, y + rand.randrange(1, height)))
+        image.paste((rand.randrange(256), rand.randrange(256), rand.randrange(256)), box)
+    return image
+
+
+def build_corpus(dir, seed=0, max_pixels=None):
+    """
+    Writes the benchmark corpus to a directory, returning a list of
+    {'name', 'path', 'format', 'bytes'} dicts. The same seed always produces
+    the same images.
+    """
+    corpus = []
+    for name, kind, width, height in CORPUS:
+        if max_pixels and width * height > max_pixels:
+            continue
+
+        # seeding with a string goes through hash(), which differs between builds and with
+        # hash randomisation; an integer seeds the same everywhere
+        rand = random.Random(int(hashlib.sha1('%s-%s' % (seed, name)).hexdigest(), 16))
+        if kind == 'photo':
+            path, format = os.path.join(dir, name + '.jpg'), 'JPEG'
+            _photo(rand, width, height).save(path, 'JPEG', quality=90)
+        elif kind == 'flat':
+            path, format = os.path.join(dir, name + '.png'), 'PNG'
+            _flat(rand, width, height).save(path, 'PNG')
+        elif kind == 'noise':
+            path, format = os.path.join(dir, name + '.png'), 'PNG'
+            _noise(rand, width, height).save(path, 'PNG')
+        elif kind == 'gif':
+            path, format = os.path.join(dir, name + '.gif'), 'GIF'
+            _flat(rand, width, height).convert('P').save(path, 'GIF')
+        else:
+            path, format = os.path.join(dir, name + '.gif'), 'GIF'
+            frames = [_flat(rand, width, height).convert('P') for i in range(12)]
+            frames[0].save(path, 'GIF', save_all=True, append_images=frames[1:], duration=80, loop=0)
+
+        corpus.append({'name': name, 'path': path, 'format': format,
+                       'bytes': os.path.getsize(path)})
+    return corpus
+
+
+def _run_flask_optimizer(key):
+    app = Flask(__name__)
+    app.config['OPTIMIZE_CACHE'] = False
+    app.config['OPTIMIZE_WORKERS'] = 0
+    Optimize(app)
+
+    def run(path, output):
+        with app.app_context():
+            get_optimizer(key).squish(path, output)
+    return run
+
+
+def _run_smush_optimiser(optimiser, format):
+    def run(path, output):
+        shutil.copyfile(path, output)
+        optimiser.set_input(output, format)
+        optimiser.optimise()
+    return run
+
+
+def get_runner(name):
+    """
+    Returns a function(path, output) that optimizes 'path' to 'output' with
+    the named pipeline
+    """
+    kwargs = {'quiet': True, 'list_only': False, 'strip_jpg_meta': True}
+    if name == 'PNGOptimizer':
+        return _run_flask_optimizer('PNG')
+    elif name == 'JPGOptimizer':
+        return _run_flask_optimizer('JPEG')
+    elif name == 'OptimisePNG':
+        return _run_smush_optimiser(OptimisePNG(**kwargs), 'PNG')
+    elif name == 'OptimiseJPG':
+        return _run_smush_optimiser(OptimiseJPG(**kwargs), 'JPEG')
+    elif name == 'OptimiseGIF':
+        return _run_smush_optimiser(OptimiseGIF(**kwargs), None)
+    raise ValueError('Unknown pipeline %s' % name)
+
+
+def benchmark(name, corpus, workdir, repeat=1):
+    """
+    Runs a pipeline over every corpus file of the formats it handles and
+    returns its timings and savings
+    """
+    tools, formats = PIPELINES[name]
+    missing = [tool for tool in tools if which(tool) is None]
+    files = [entry for entry in corpus if entry['format'] in formats]
+    result = {'available': not missing, 'missing_tools': missing, 'files': len(files) * repeat}
+    if missing or not files:
+        return result
+
+    run = get_runner(name)
+    bytes_in = bytes_out = 0
+    failures = 0
+    start_times = os.times()
+    start = time.time()
+
+    for i in range(repeat):
+        for entry in files:
+            output = os.path.join(workdir, '%s-%s' % (name, os.path.basename(entry['path'])))
+            try:
+                run(entry['path'], output)
+            except Exception:
+                logging.exception('%s failed on %s' % (name, entry['name']))
+                failures += 1
+                continue
+            bytes_in += entry['bytes']
+            bytes_out += os.path.getsize(output) if os.path.exists(output) else entry['bytes']
+            if os.path.exists(output):
+                os.unlink(output)
+
+    wall_time = time.time() - start
+    end_times = os.times()
+    # user and system time of this process and of the tools it ran
+    cpu_time = sum(end_times[i] - start_times[i] for i in range(4))
+
+    result.update({
+        'failures': failures,
+        'wall_time': round(wall_time, 4),
+        'cpu_time': round(cpu_time, 4),
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'bytes_saved': bytes_in - bytes_out,
+        'files_per_second': round(len(files) * repeat / wall_time, 3) if wall_time else None,
+    })
+    return result
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ho:', ['help', 'output=', 'corpus=', 'seed=',
+                                                         'max-pixels=', 'pipelines=', 'repeat='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    output = None
+    corpus_dir = None
+    seed = 0
+    max_pixels = None
+    pipelines = sorted(PIPELINES)
+    repeat = 1
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt == '--corpus':
+            corpus_dir = arg
+        elif opt == '--seed':
+            seed = int(arg)
+        elif opt == '--max-pixels':
+            max_pixels = int(arg)
+        elif opt == '--pipelines':
+            pipelines = [name for name in arg.split(',') if name]
+        elif opt == '--repeat':
+            repeat = int(arg)
+
+    for name in pipelines:
+        if name not in PIPELINES:
+            logging.error('Unknown pipeline %s' % name)
+            sys.exit(2)
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+
+    workdir = tempfile.mkdtemp(prefix='optimize-benchmark-')
+    try:
+        if corpus_dir is None:
+            corpus_dir = os.path.join(workdir, 'corpus')
+        if not os.path.isdir(corpus_dir):
+            os.makedirs(corpus_dir)
+        corpus = build_corpus(corpus_dir, seed, max_pixels)
+
+        report = {
+            'seed': seed,
+            'corpus': [dict((k, v) for k, v in entry.items() if k != 'path') for entry in corpus],
+            'pipelines': dict((name, benchmark(name, corpus, workdir, repeat)) for name in pipelines),
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+    report = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        f = open(output, 'w')
+        f.write(report + '\n')
+        f.close()
+    else:
+        print report
+
+
+def usage():
+    print """Benchmarks the image optimization pipelines against a generated corpus.
+
+  Usage: """ + sys.argv[0] + """ [options]
+
+  Options are any of:
+  -h, --help           Display this help message and exit
+  -o, --output=FILE    Write the JSON report to FILE instead of stdout
+  --corpus=DIR         Generate the corpus in DIR (and keep it)
+  --seed=N             Seed for generating the corpus (default 0)
+  --max-pixels=N       Leave out corpus images larger than N pixels
+  --pipelines=NAMES    Comma separated pipelines to run (default all):
+                       """ + ', '.join(sorted(PIPELINES)) + """
+  --repeat=N           Run each pipeline over the corpus N times
+"""
+
+if __name__ == '__main__':
+    main()
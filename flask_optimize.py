@@ -10,21 +10,58 @@
 """
 import os
 import os.path
+import atexit
+import collections
+import hashlib
+import io
+import itertools
+import json
+import mimetypes
 import shlex
+import sqlite3
 import subprocess
 import sys
 import shutil
 import tempfile
-import Image
+import threading
+import time
+import Queue
 from contextlib import contextmanager
-from flask import current_app
+from flask import current_app, request
+from flask.signals import Namespace
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 _default_config = {
     'DEFAULT_DEST': 'min',
     'IMAGE_EXTENSIONS': ['jpg', 'jpeg', 'png', 'gif'],
-    'STRIP_META': True
+    'STRIP_META': True,
+    'CACHE': True,
+    'CACHE_MAX_BYTES': None,
+    'CACHE_EVICTION': 'lru',
+    'MEMORY_CACHE_BYTES': 0,
+    'MEMORY_CACHE_SHARED': False,
+    'MEMORY_CACHE_SHARED_BYTES': None,
+    'WORKERS': 2,
+    'QUEUE_SIZE': 100,
+    'RESPONSES': False,
+    'LEVEL': 'max',
+    'TIME_BUDGET': None,
+    'BACKEND': 'auto',
+    'SPAWN_HELPER': False,
+    'VARIANT_WIDTHS': [320, 640, 1024, 1920],
+    'VARIANT_QUALITY': 85,
+    'WEBP': False,
+    'WEBP_QUALITY': 80
 }
 
+# command line tools looked for by init_app, as well as those used by the
+# optimizers
+PROBED_TOOLS = ('pngnq', 'pngcrush', 'jpegtran', 'gifsicle', 'identify', 'cwebp')
+
 # Find the stack on which we want to store the optimizer.
 # Starting with Flask 0.9, the _app_ctx_stack is the correct one,
 # before that we need to use the _request_ctx_stack.
@@ -34,12 +71,43 @@ except ImportError:
     from flask import _request_ctx_stack as stack
 
 
+_signals = Namespace()
+
+# sent with the app as sender, and path (None for in-memory images), format,
+# bytes_in, bytes_out, seconds and cached keyword arguments
+image_optimized = _signals.signal('image-optimized')
+
+# sent with the app as sender, and path, format and error keyword arguments
+optimize_failed = _signals.signal('optimize-failed')
+
+
 class OptimizerIndeterminableError(Exception):
     pass
 
+
+# what Optimize.probe finds out about an image. ``size`` is the file size in
+# bytes, and ``frames`` the number of frames (more than 1 for animations)
+ImageInfo = collections.namedtuple('ImageInfo', 'format width height mode frames size')
+
+
 class Optimize(object):
 
+    # number of files whose ImageInfo is remembered by probe
+    probe_cache_size = 10000
+
     def __init__(self, app=None):
+        self.cache = None
+        self.hot = None
+        # content hash of each file served by send_image, by path, mtime and size
+        self._digests = {}
+        # ImageInfo of probed files, by device, inode, size and mtime
+        self._probes = collections.OrderedDict()
+        self._probes_lock = threading.Lock()
+        self.jobs = None
+        self.spawner = None
+        self.capabilities = {}
+        self.pipelines = None
+        self.stats = Metrics()
         if app is not None:
             self.app = app
             self.init_app(self.app)
@@ -50,36 +118,766 @@ class Optimize(object):
         for key, value in _default_config.items():
                     app.config.setdefault('OPTIMIZE_' + key, value)
         
+        if app.config['OPTIMIZE_LEVEL'] not in Optimizer.levels:
+            raise ValueError('OPTIMIZE_LEVEL must be one of %s' % ', '.join(Optimizer.levels))
+
+        if app.config['OPTIMIZE_BACKEND'] not in ('auto', 'tools', 'pillow'):
+            raise ValueError('OPTIMIZE_BACKEND must be one of auto, tools, pillow')
+
+        if app.config['OPTIMIZE_CACHE_EVICTION'] not in CacheIndex.policies:
+            raise ValueError('OPTIMIZE_CACHE_EVICTION must be one of %s'
+                             % ', '.join(CacheIndex.policies))
+
+        # find the tools once, so requests never try to run missing ones
+        self.capabilities = probe_tools(get_tool_names())
+        self.pipelines = self._configure_pipelines(app)
+
+        # start the helper before any threads, while the process is small
+        if app.config['OPTIMIZE_SPAWN_HELPER']:
+            self.spawner = SpawnHelper()
+            atexit.register(self.spawner.close)
+
+        if app.config['OPTIMIZE_CACHE']:
+            self.cache = ResultCache(os.path.join(get_dest_path(app), '.cache'),
+                                     app.config['OPTIMIZE_CACHE_MAX_BYTES'],
+                                     app.config['OPTIMIZE_CACHE_EVICTION'])
+        else:
+            self.cache = None
+
+        if app.config['OPTIMIZE_MEMORY_CACHE_BYTES']:
+            shared = None
+            if app.config['OPTIMIZE_MEMORY_CACHE_SHARED']:
+                shared = get_shared_path(app)
+            self.hot = HotCache(app.config['OPTIMIZE_MEMORY_CACHE_BYTES'], shared,
+                                app.config['OPTIMIZE_MEMORY_CACHE_SHARED_BYTES'])
+            if shared is not None:
+                atexit.register(self.hot.close)
+
+        if app.config['OPTIMIZE_WORKERS'] > 0:
+            self.jobs = JobQueue(app, self, app.config['OPTIMIZE_WORKERS'],
+                                 app.config['OPTIMIZE_QUEUE_SIZE'])
+            self.jobs.start()
+            atexit.register(self.jobs.shutdown)
+
+        if app.config['OPTIMIZE_RESPONSES']:
+            app.after_request(self._optimize_response)
+
+        # the 'flask optimize' commands, on Flask versions with a CLI
+        if hasattr(app, 'cli'):
+            app.cli.add_command(make_cli())
+
         app.optimize = self
         
     def smush(self, file, output=None):
         """
-        Optimizes a file
+        Optimizes a file, writing the result to ``output`` (or back over
+        ``file`` when no output is given). Returns the output path.
         """
-        
-        key = self.get_image_format(file)
-        
-        optimizer = get_optimizer(key)
-        
-        if not optimizer: 
-            raise OptimizerIndeterminableError()
+        if output is None:
+            output = file
+
+        start = time.time()
+        key = None
+        try:
+            key = self.get_image_format(file)
             
-        optimizer.squish(file, output)
+            optimizer = self.get_optimizer(key)
             
-    def get_image_format(self, path):
+            if not optimizer: 
+                raise OptimizerIndeterminableError()
+
+            bytes_in = os.path.getsize(file)
+
+            cache_key = None
+            if self.cache is not None:
+                cache_key = self._get_cache_key(hash_file(file), optimizer)
+                if self.cache.get(cache_key, output):
+                    current_app.logger.debug("Cache hit for %s (%s)", file, cache_key)
+                    self._record(file, key, start, bytes_in, os.path.getsize(output), cached=True)
+                    return output
+
+            optimizer.squish(file, output)
+
+            if cache_key is not None and os.path.exists(output):
+                self.cache.put(cache_key, output)
+        except Exception, e:
+            self._record_failure(file, key, e)
+            raise
+
+        self._record(file, key, start, bytes_in, os.path.getsize(output), optimizer=optimizer)
+        return output
+
+    def enqueue(self, file, output=None, block=True, timeout=None):
+        """
+        Queues ``file`` to be optimized by the background workers and returns
+        an ``OptimizeJob`` straight away. The file is replaced by its
+        optimized version (or written to ``output``) once the job is done.
+
+        The queue holds at most ``OPTIMIZE_QUEUE_SIZE`` jobs; ``block`` and
+        ``timeout`` are as for ``Queue.put``, which raises ``Queue.Full`` when
+        the queue stays full. With ``OPTIMIZE_WORKERS`` set to 0 the job is
+        run before returning.
+        """
+        job = OptimizeJob(file, output)
+        if self.jobs is None:
+            job.run(self)
+        else:
+            self.jobs.put(job, block, timeout)
+        return job
+
+    def smush_bytes(self, data):
+        """
+        Optimizes an image held in memory and returns the optimized bytes.
+        Pipeline stages that can stream are piped through stdin/stdout, so
+        only the rest touch the disk.
+        """
+        start = time.time()
+        key = None
         try:
-            img = Image.open(path)
-            current_app.logger.debug(path + ", " + img.format + ", " + ("%dx%d" % img.size) + ", " + img.mode)
+            key = self.get_image_format(io.BytesIO(data))
 
-            return img.format
-        except IOError:
-            current_app.logger.debug("Unable to determine file format ")
-            
+            optimizer = self.get_optimizer(key)
+
+            if not optimizer:
+                raise OptimizerIndeterminableError()
+
+            cache_key = None
+            if self.cache is not None:
+                cache_key = self._get_cache_key(hashlib.sha1(data).hexdigest(), optimizer)
+                cached = self.cache.get_bytes(cache_key)
+                if cached is not None:
+                    current_app.logger.debug("Cache hit for %s", cache_key)
+                    self._record(None, key, start, len(data), len(cached), cached=True)
+                    return cached
+
+            optimized = optimizer.squish_bytes(data)
+
+            if cache_key is not None:
+                self.cache.put_bytes(cache_key, optimized)
+        except Exception, e:
+            self._record_failure(None, key, e)
+            raise
+
+        self._record(None, key, start, len(data), len(optimized), optimizer=optimizer)
+        return optimized
+
+    def smush_webp(self, data):
+        """
+        Returns the image held in ``data`` re-encoded as WebP, or None if it
+        can't be or the WebP isn't smaller. Results are kept in the result
+        cache like optimized images.
+        """
+        return self._smush_webp(data)[0]
+
+    def _smush_webp(self, data):
+        """
+        Returns ``(webp, settled)``: the result of ``smush_webp``, and
+        whether it will be the same next time. A failed encoding (e.g. cwebp
+        killed by ``OPTIMIZE_TIME_BUDGET``) isn't settled, so isn't cached.
+        """
+        start = time.time()
+        key = self.get_image_format(io.BytesIO(data))
+        if key not in WebPOptimizer.formats:
+            return None, True
+        optimizer = get_optimizer(WebPOptimizer.id)
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._get_cache_key(hashlib.sha1(data).hexdigest(), optimizer)
+            cached = self.cache.get_bytes(cache_key)
+            if cached is not None:
+                # an empty entry records that WebP wasn't smaller
+                return cached or None, True
+
+        try:
+            webp = optimizer.squish_bytes(data)
+        except Exception, e:
+            self._record_failure(None, WebPOptimizer.id, e)
+            raise
+        if webp is None:
+            return None, False
+
+        if len(webp) >= len(data):
+            webp = None
+        if cache_key is not None:
+            self.cache.put_bytes(cache_key, webp or '')
+        if webp is not None:
+            self._record(None, WebPOptimizer.id, start, len(data), len(webp), optimizer=optimizer)
+        return webp, True
+
+    def smush_file(self, input, output=None):
+        """
+        Optimizes the image read from file-like object ``input``, writing it
+        to file-like ``output`` (a new ``BytesIO`` if not given). Returns the
+        output file, positioned at the start if it was created here.
+        """
+        optimized = self.smush_bytes(input.read())
+        if output is None:
+            return io.BytesIO(optimized)
+        output.write(optimized)
+        return output
+
+    def variants(self, path, widths=None):
+        """
+        Makes resized copies of the image at ``path`` for use in a
+        ``srcset``, one per width in ``widths`` (``OPTIMIZE_VARIANT_WIDTHS``
+        by default), keeping the aspect ratio. Widths larger than the image
+        are left out. The image is decoded once; the copies are then resized,
+        encoded and optimized in parallel.
+
+        The copies are written to ``OPTIMIZE_DEFAULT_DEST`` as
+        ``<name>-<width>w.<ext>``, next to a ``<name>.<ext>.variants.json``
+        manifest listing them, in the same folder the image is in under the
+        static folder (as with ``build_static``); images from outside it
+        get a folder named after a hash of theirs. Returns the manifest,
+        whose paths are relative to ``OPTIMIZE_DEFAULT_DEST``.
+        """
+        if widths is None:
+            widths = current_app.config['OPTIMIZE_VARIANT_WIDTHS']
+
+        # animations would lose every frame but the first
+        info = self.probe(path)
+        if info is None or info.format not in ('PNG', 'JPEG', 'GIF') or info.frames > 1:
+            raise OptimizerIndeterminableError()
+        format = info.format
+
+        size = (info.width, info.height)
+        widths = sorted(set(width for width in widths if 0 < width <= size[0]))
+        img = None
+        if widths:
+            img = _import_image().open(path)
+            # JPEGs can be decoded straight to a smaller scale, as long as
+            # it's no smaller than the largest variant
+            img.draft(img.mode, (widths[-1], widths[-1] * size[1] // size[0]))
+            img.load()
+
+        # images with the same name in different folders mustn't overwrite
+        # each other's variants
+        app = current_app._get_current_object()
+        root = get_dest_path(app)
+        folder = os.path.dirname(os.path.abspath(path))
+        relpath = os.path.relpath(folder, os.path.abspath(app.static_folder or app.root_path))
+        if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+            relpath = hashlib.sha1(folder).hexdigest()[:12]
+        dest = os.path.normpath(os.path.join(root, relpath))
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        name, ext = os.path.splitext(os.path.basename(path))
+
+        results = [None] * len(widths)
+        errors = []
+
+        def work(i):
+            output = os.path.join(dest, '%s-%dw%s' % (name, widths[i], ext))
+            try:
+                with app.app_context():
+                    height = self._write_variant(img, format, size, widths[i], output, path)
+                    self.smush(output)
+            except Exception, e:
+                errors.append(e)
+                return
+            results[i] = {'width': widths[i], 'height': height,
+                          'path': os.path.relpath(output, root),
+                          'bytes': os.path.getsize(output)}
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(len(widths))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        manifest = {'source': os.path.abspath(path), 'format': format,
+                    'width': size[0], 'height': size[1], 'variants': results}
+        temp = make_temp_file(os.path.join(dest, name))
+        with open(temp, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        replace_file(temp, os.path.join(dest, name + ext + '.variants.json'), path)
+        return manifest
+
+    def _write_variant(self, img, format, size, width, output, source):
+        """
+        Writes ``img``, resized to ``width``, to ``output`` with the same
+        permissions as the ``source`` file. Returns the height it was resized
+        to.
+        """
+        Image = _import_image()
+        height = max(1, int(round(float(size[1]) * width / size[0])))
+
+        # palette images are resized in full colour, then reduced to a
+        # palette again for formats that can hold one
+        palette = img.mode == 'P'
+        if palette:
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        elif img.mode not in ('RGB', 'RGBA', 'L'):
+            img = img.convert('RGB')
+        resized = img.resize((width, height), Image.ANTIALIAS)
+
+        kwargs = {}
+        if format == 'JPEG':
+            if resized.mode == 'RGBA':
+                resized = resized.convert('RGB')
+            kwargs['quality'] = current_app.config['OPTIMIZE_VARIANT_QUALITY']
+            if not current_app.config['OPTIMIZE_STRIP_META']:
+                for key in ('exif', 'icc_profile'):
+                    if key in img.info:
+                        kwargs[key] = img.info[key]
+        elif format == 'GIF':
+            resized = resized.convert('P', palette=Image.ADAPTIVE)
+        elif format == 'PNG' and palette:
+            try:
+                resized = resized.quantize(256)
+            except ValueError:
+                # classic PIL can't quantize images with an alpha channel
+                pass
+
+        temp = make_temp_file(output)
+        try:
+            resized.save(temp, format, **kwargs)
+            replace_file(temp, output, source)
+        except:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+        return height
+
+    def metrics(self):
+        """
+        Returns a snapshot of the optimization counters and histograms (see
+        ``Metrics.snapshot``)
+        """
+        return self.stats.snapshot()
+
+    def _record(self, path, format, start, bytes_in, bytes_out, cached=False, optimizer=None):
+        """
+        Records a successful optimization in the metrics and sends the
+        ``image_optimized`` signal
+        """
+        seconds = time.time() - start
+        format = format or 'unknown'
+        self.stats.incr('invocations', format=format)
+        self.stats.incr('bytes_in', bytes_in, format=format)
+        self.stats.incr('bytes_out', bytes_out, format=format)
+        self.stats.observe('seconds', seconds, format=format)
+        if cached:
+            self.stats.incr('cache_hits', format=format)
+        if optimizer is not None and optimizer.winner is not None:
+            self.stats.incr('winners', format=format, command=optimizer.winner)
+
+        image_optimized.send(current_app._get_current_object(), path=path, format=format,
+                             bytes_in=bytes_in, bytes_out=bytes_out, seconds=seconds,
+                             cached=cached)
+
+    def _record_failure(self, path, format, error):
+        """
+        Records a failed optimization in the metrics and sends the
+        ``optimize_failed`` signal
+        """
+        format = format or 'unknown'
+        self.stats.incr('invocations', format=format)
+        self.stats.incr('failures', format=format)
+        optimize_failed.send(current_app._get_current_object(), path=path, format=format,
+                             error=error)
+
+    def get_optimizer(self, format):
+        """
+        Returns the optimizer to use for an image format, or None if it
+        can't be optimized. The choice is made once, by ``init_app``.
+        """
+        if self.pipelines is None:
+            self.pipelines = self._configure_pipelines(current_app)
+
+        id = self.pipelines.get(format)
+        if id is None:
+            return None
+        return get_optimizer(id)
+
+    def _configure_pipelines(self, app):
+        """
+        Chooses the optimizer for each image format, as set by
+        ``OPTIMIZE_BACKEND``: ``tools`` for the command line tools, ``pillow``
+        to re-encode in-process with Pillow, or ``auto`` to use the tools
+        when they are installed and fall back to Pillow otherwise. ``auto``
+        only falls back for formats Pillow re-encodes losslessly, so JPEGs
+        are left alone without jpegtran. Returns a dict of format to
+        optimizer id (None when nothing can optimize it).
+        """
+        backend = app.config['OPTIMIZE_BACKEND']
+        registry = Optimizer.__metaclass__.REGISTRY
+        # encoders to other formats aren't used to optimize images
+        formats = set(id for id, optimizer in registry.items()
+                      if id != PillowOptimizer.id and optimizer.output_format is None)
+        formats.update(PillowOptimizer.formats)
+
+        pipelines = {}
+        for format in formats:
+            optimizer = registry.get(format)
+            if optimizer is not None and optimizer.output_format is not None:
+                optimizer = None
+            missing = []
+            if optimizer is not None:
+                missing = [tool for tool in optimizer.tools if not self.capabilities.get(tool)]
+
+            if backend == 'auto' and missing and format in PillowOptimizer.lossy_formats:
+                app.logger.warning("Not optimizing %s images: %s not installed, and Pillow "
+                                   "can't re-encode them losslessly (set OPTIMIZE_BACKEND "
+                                   "to 'pillow' to re-encode anyway)", format, ', '.join(missing))
+                id = None
+            elif backend == 'pillow' or (backend == 'auto' and (optimizer is None or missing)):
+                id = PillowOptimizer.id if format in PillowOptimizer.formats else None
+            elif missing:
+                app.logger.warning("Not optimizing %s images: %s not installed",
+                                   format, ', '.join(missing))
+                id = None
+            else:
+                id = optimizer.id if optimizer is not None else None
+            pipelines[format] = id
+        return pipelines
+
+    def _optimize_response(self, response):
+        """
+        ``after_request`` hook that optimizes image responses of the types in
+        ``OPTIMIZE_IMAGE_EXTENSIONS``, sending WebP to clients that accept it
+        if ``OPTIMIZE_WEBP`` is set.
+        """
+        return self.optimize_response(response, current_app.config['OPTIMIZE_WEBP'])
+
+    def optimize_response(self, response, webp=False):
+        """
+        Optimizes an image response of one of the types in
+        ``OPTIMIZE_IMAGE_EXTENSIONS``. With ``webp``, clients whose ``Accept``
+        header lists ``image/webp`` get a WebP version instead when it's
+        smaller, and the response varies on ``Accept``. Bodies are served
+        from the memory cache (with ``OPTIMIZE_MEMORY_CACHE_BYTES``) or the
+        result cache on later hits, with a strong ETag so clients can
+        revalidate with a 304.
+        """
+        if response.status_code != 200 or getattr(response, 'optimized', False):
+            return response
+
+        types = get_image_mimetypes(current_app.config['OPTIMIZE_IMAGE_EXTENSIONS'])
+        if response.mimetype not in types:
+            return response
+
+        # read files sent with send_file into memory so they can be optimized
+        response.direct_passthrough = False
+        data = response.get_data()
+        accept = webp and accepts_webp(request)
+        if webp:
+            response.vary.add('Accept')
+
+        hot_key = None
+        entry = None
+        if self.hot is not None:
+            hot_key = self._get_hot_key(hashlib.sha1(data).hexdigest(), accept)
+            entry = self.hot.get(hot_key)
+
+        if entry is None:
+            try:
+                optimized = None
+                settled = True
+                mimetype = response.mimetype
+                if accept:
+                    optimized, settled = self._smush_webp(data)
+                    if optimized is not None:
+                        mimetype = 'image/webp'
+                if optimized is None:
+                    optimized = self.smush_bytes(data)
+            except (OptimizerIndeterminableError, ValueError):
+                return response
+
+            entry = (optimized, mimetype, hashlib.sha1(optimized).hexdigest())
+            # after a failed WebP encoding, try again next time
+            if hot_key is not None and settled:
+                self.hot.put(hot_key, *entry)
+
+        return self._finish_response(response, entry)
+
+    def send_image(self, path, webp=True):
+        """
+        Returns a response serving the image file at ``path`` optimized, and
+        as WebP to clients that accept it (see ``optimize_response``). Images
+        in the memory cache are served after a single ``stat``, without
+        reading the file.
+        """
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        accept = webp and accepts_webp(request)
+
+        stamp = None
+        if self.hot is not None:
+            st = os.stat(path)
+            stamp = (path, st.st_mtime, st.st_size)
+            digest = self._digests.get(stamp)
+            if digest is not None:
+                entry = self.hot.get(self._get_hot_key(digest, accept))
+                if entry is not None:
+                    response = current_app.response_class(mimetype=mimetype)
+                    if webp:
+                        response.vary.add('Accept')
+                    return self._finish_response(response, entry)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        if stamp is not None:
+            if len(self._digests) > 10000:
+                self._digests.clear()
+            self._digests[stamp] = hashlib.sha1(data).hexdigest()
+
+        response = current_app.response_class(data, mimetype=mimetype)
+        return self.optimize_response(response, webp)
+
+    def _finish_response(self, response, entry):
+        """
+        Sets a response's body, type and ETag to a ``(body, mimetype, etag)``
+        memory cache entry, and makes it conditional on the request
+        """
+        body, mimetype, etag = entry
+        response.set_data(body)
+        response.mimetype = mimetype
+        response.set_etag(etag)
+        # so the after_request hook leaves responses from send_image alone
+        response.optimized = True
+        return response.make_conditional(request)
+
+    def _get_hot_key(self, digest, webp):
+        """
+        Builds the memory cache key for serving an image with content hash
+        ``digest``, as WebP if ``webp`` and the client accepts it
+        """
+        return '%s-%s' % (digest, 'webp' if webp else 'same')
+
+    def _get_cache_key(self, digest, optimizer):
+        """
+        Builds the result cache key for optimizing an input with content hash
+        ``digest`` with ``optimizer``: the hash plus everything that changes
+        the pipeline output (format, meta stripping and the installed tool
+        binaries).
+        """
+        parts = [digest, optimizer.id,
+                 'strip_meta=%s' % current_app.config['OPTIMIZE_STRIP_META'],
+                 'level=%s' % current_app.config['OPTIMIZE_LEVEL']]
+        if optimizer.output_format == 'WEBP':
+            parts.append('quality=%s' % current_app.config['OPTIMIZE_WEBP_QUALITY'])
+        for tool in optimizer.tools:
+            parts.append('%s=%s' % (tool, tool_fingerprint(tool)))
+        return hashlib.sha1('\n'.join(parts)).hexdigest()
             
+    def get_image_format(self, path):
+        """
+        Returns the image format of ``path``, a file name or file-like
+        object, or None if it isn't an image
+        """
+        info = self.probe(path)
+        if info is None:
+            return None
+        return info.format
 
+    def probe(self, path):
+        """
+        Returns the ``ImageInfo`` of ``path``, a file name or file-like
+        object, or None if it isn't an image. Only the image header is read
+        (and for animations, the frame headers). Results for files are
+        remembered until the file changes.
+        """
+        if not isinstance(path, basestring):
+            return self._probe(path, None)
 
+        try:
+            st = os.stat(path)
+        except OSError:
+            current_app.logger.debug("Unable to determine file format of %s", path)
+            return None
+
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        with self._probes_lock:
+            info = self._probes.pop(key, None)
+            if info is not None:
+                self._probes[key] = info
+                return info
+
+        info = self._probe(path, st.st_size)
+        if info is not None:
+            with self._probes_lock:
+                self._probes[key] = info
+                while len(self._probes) > self.probe_cache_size:
+                    self._probes.popitem(last=False)
+        return info
+
+    def probe_many(self, paths):
+        """
+        Probes several files at once, returning a dict of path to
+        ``ImageInfo`` (or None for files that aren't images)
+        """
+        return dict((path, self.probe(path)) for path in paths)
+
+    def _probe(self, path, size):
+        name = getattr(path, 'name', path)
+        try:
+            img = _import_image().open(path)
+            frames = count_frames(img)
+        except (IOError, EOFError):
+            current_app.logger.debug("Unable to determine file format of %s", name)
+            return None
 
+        if size is None:
+            # the rest of a file-like object
+            position = path.tell()
+            path.seek(0, os.SEEK_END)
+            size = int(path.tell())
+            path.seek(position)
 
+        current_app.logger.debug("%s, %s, %dx%d, %s, %d frames", name, img.format,
+                                 img.size[0], img.size[1], img.mode, frames)
+        return ImageInfo(img.format, img.size[0], img.size[1], img.mode, frames, size)
+
+
+
+
+def make_cli():
+    """
+    Returns the ``optimize`` click command group added to ``flask`` by
+    ``init_app``
+    """
+    import click
+    from flask.cli import with_appcontext
+
+    @click.group('optimize', help='Optimize images.')
+    def cli():
+        pass
+
+    @cli.command('build')
+    @click.option('-j', '--jobs', type=int, default=0,
+                  help='Worker processes to optimize with (default one per CPU).')
+    @click.option('--force', is_flag=True,
+                  help='Optimize every image, even if its output is up to date.')
+    @click.option('--manifest', type=click.Path(dir_okay=False), default=None,
+                  help='Where to write the manifest (default manifest.json in the destination).')
+    @with_appcontext
+    def build(jobs, force, manifest):
+        """Optimize the static folder's images into OPTIMIZE_DEFAULT_DEST."""
+        result = build_static(current_app._get_current_object(), jobs or None, force, manifest)
+        click.echo('%d images optimized, %d up to date, %d failed. Saved %dkb' % (
+            result['optimized'], result['skipped'], len(result['failed']),
+            result['bytes_saved'] / 1024))
+        for path, error in sorted(result['failed'].items()):
+            click.echo('  %s: %s' % (path, error), err=True)
+
+    return cli
+
+
+def build_static(app, jobs=None, force=False, manifest=None):
+    """
+    Optimizes every image in ``app.static_folder`` with one of the
+    ``OPTIMIZE_IMAGE_EXTENSIONS`` into ``OPTIMIZE_DEFAULT_DEST``, keeping the
+    folder structure, in a pool of ``jobs`` worker processes (one per CPU
+    by default). Images whose output is newer than them are skipped unless
+    ``force`` is set. Images that can't be optimized are copied as-is, as
+    are those that fail, which are tried again by the next build; any that
+    can't even be copied are left out of the manifest.
+
+    Writes a JSON manifest mapping each image's path to its output's, both
+    relative to the static folder, to ``manifest`` (``manifest.json`` in
+    the destination by default), and returns a summary of the build.
+    """
+    import multiprocessing
+
+    source = os.path.abspath(app.static_folder)
+    dest = get_dest_path(app)
+    if manifest is None:
+        manifest = os.path.join(dest, 'manifest.json')
+
+    files = {}
+    tasks = []
+    for path in find_images(source, app.config['OPTIMIZE_IMAGE_EXTENSIONS'], [dest]):
+        relpath = os.path.relpath(path, source)
+        output = os.path.join(dest, relpath)
+        files[relpath] = os.path.relpath(output, source)
+        if not force and os.path.exists(output) and \
+                os.path.getmtime(output) >= os.path.getmtime(path):
+            continue
+        if not os.path.isdir(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        tasks.append((path, output))
+
+    result = {'optimized': 0, 'skipped': len(files) - len(tasks), 'failed': {},
+              'bytes_saved': 0}
+
+    # workers inherit the app when the pool forks
+    global _build_app
+    _build_app = app
+    pool = multiprocessing.Pool(jobs, _init_build_worker)
+    try:
+        for path, bytes_in, bytes_out, error in pool.imap_unordered(_build_worker, tasks):
+            if error is not None:
+                relpath = os.path.relpath(path, source)
+                result['failed'][relpath] = error
+                if not os.path.exists(os.path.join(dest, relpath)):
+                    del files[relpath]
+            else:
+                result['optimized'] += 1
+                result['bytes_saved'] += bytes_in - bytes_out
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _build_app = None
+
+    if not os.path.isdir(os.path.dirname(manifest)):
+        os.makedirs(os.path.dirname(manifest))
+    temp = make_temp_file(manifest)
+    with open(temp, 'w') as f:
+        json.dump(files, f, indent=2, sort_keys=True)
+    replace_file(temp, manifest, source)
+    return result
+
+
+def find_images(path, extensions, exclude=()):
+    """
+    Yields the files under ``path`` with one of ``extensions``, leaving out
+    dot files and the directories in ``exclude``
+    """
+    extensions = set('.' + ext.lower() for ext in extensions)
+    exclude = set(os.path.abspath(dir) for dir in exclude)
+    for dir, dirs, files in os.walk(path):
+        dirs[:] = [name for name in dirs if not name.startswith('.')
+                   and os.path.join(dir, name) not in exclude]
+        for name in files:
+            if not name.startswith('.') and os.path.splitext(name)[1].lower() in extensions:
+                yield os.path.join(dir, name)
+
+
+# the app being built by each process in a build_static worker pool
+_build_app = None
+
+def _init_build_worker():
+    # pool workers are daemonic, so can't start a spawn helper of their own;
+    # they're forked while small anyway
+    _build_app.optimize.spawner = None
+    _build_app.app_context().push()
+
+def _build_worker(task):
+    path, output = task
+    bytes_in = os.path.getsize(path)
+    try:
+        try:
+            current_app.optimize.smush(path, output)
+        except OptimizerIndeterminableError:
+            copy_file(path, output)
+        return path, bytes_in, os.path.getsize(output), None
+    except Exception, e:
+        current_app.logger.exception("Unable to optimize %s", path)
+        # keep the destination complete with the original, dated before it
+        # so the next build tries again
+        try:
+            copy_file(path, output)
+            stat = os.stat(path)
+            os.utime(output, (stat.st_atime, stat.st_mtime - 1))
+        except (IOError, OSError):
+            current_app.logger.error("Unable to copy %s to %s", path, output)
+        return path, bytes_in, bytes_in, str(e) or e.__class__.__name__
 
 
 def common_path_prefix(paths, sep=os.path.sep):
@@ -96,6 +894,206 @@ def common_path_prefix(paths, sep=os.path.sep):
     return sep.join(x[0] for x in takewhile(allnamesequal, bydirectorylevels))
 
 
+def get_dest_path(app):
+    """Returns the absolute path of ``OPTIMIZE_DEFAULT_DEST``. Relative
+    destinations are resolved against the app's static folder.
+    """
+    dest = app.config['OPTIMIZE_DEFAULT_DEST']
+    if not os.path.isabs(dest):
+        dest = os.path.join(app.static_folder or app.root_path, dest)
+    return dest
+
+
+def get_shared_path(app):
+    """
+    Returns the directory on ``/dev/shm`` where the app's worker processes
+    share their memory cache entries, creating it if needed. Returns None,
+    with a warning, where there is no ``/dev/shm``.
+    """
+    if not os.path.isdir('/dev/shm'):
+        app.logger.warning("OPTIMIZE_MEMORY_CACHE_SHARED needs /dev/shm; not sharing")
+        return None
+
+    name = 'flask-optimize-' + hashlib.sha1(get_dest_path(app)).hexdigest()[:12]
+    path = os.path.join('/dev/shm', name)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def accepts_webp(request):
+    """Returns whether a request's ``Accept`` header lists ``image/webp``."""
+    return any(value == 'image/webp' and quality > 0
+               for value, quality in request.accept_mimetypes)
+
+
+def get_image_mimetypes(extensions):
+    """Returns the set of mimetypes for a list of image file extensions."""
+    types = set()
+    for ext in extensions:
+        type, encoding = mimetypes.guess_type('image.' + ext)
+        if type is not None:
+            types.add(type)
+    return types
+
+
+def hash_file(path, blocksize=65536):
+    """Returns the hex SHA1 digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# os.replace is only in Python 3; os.rename is just as atomic on POSIX
+_replace = getattr(os, 'replace', os.rename)
+
+
+def make_temp_file(near=None, suffix='.optimize'):
+    """
+    Creates an empty temp file and returns its path. If ``near`` is given
+    the file is made in the same directory, so it can later be renamed over
+    ``near`` without copying (or over the file it links to, if it's a
+    symlink); the system temp directory is used if that directory isn't
+    writable.
+    """
+    if near is not None:
+        try:
+            fd, path = tempfile.mkstemp(suffix=suffix, prefix='.optimize-',
+                                        dir=os.path.dirname(os.path.realpath(near)))
+            os.close(fd)
+            return path
+        except OSError:
+            pass
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return path
+
+
+def replace_file(path, target, mode_from=None):
+    """
+    Moves ``path`` over ``target`` with an atomic rename, so readers of
+    ``target`` see the old file or the new one but never part of either.
+    The permissions of ``mode_from`` (``target`` if it exists) are kept. If
+    the two are on different filesystems ``path`` is copied next to
+    ``target`` first. If ``target`` is a symlink the file it points to is
+    replaced, leaving the link in place.
+    """
+    target = os.path.realpath(target)
+    if mode_from is None and os.path.exists(target):
+        mode_from = target
+    if mode_from is not None:
+        shutil.copymode(mode_from, path)
+    try:
+        _replace(path, target)
+    except OSError:
+        copy_file(path, target, mode_from)
+        os.unlink(path)
+
+
+def copy_file(path, target, mode_from=None):
+    """
+    Copies ``path`` to ``target`` through a temp file in the same directory,
+    so ``target`` is replaced atomically. A symlinked ``target`` is
+    followed, as in :func:`replace_file`.
+    """
+    target = os.path.realpath(target)
+    temp = make_temp_file(target)
+    try:
+        shutil.copyfile(path, temp)
+        shutil.copymode(mode_from or path, temp)
+        _replace(temp, target)
+    except:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+
+def _import_image():
+    """
+    Returns the PIL ``Image`` module, importing it the first time it's
+    needed rather than when the app starts
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        # classic PIL
+        import Image
+    return Image
+
+
+def count_frames(img):
+    """
+    Returns the number of frames in an image. Classic PIL has no
+    ``n_frames``, so the frames are seeked through instead.
+    """
+    frames = getattr(img, 'n_frames', None)
+    if frames is not None:
+        return frames
+
+    frames = 1
+    try:
+        while True:
+            img.seek(frames)
+            frames += 1
+    except EOFError:
+        pass
+    img.seek(0)
+    return frames
+
+
+def get_tool_names():
+    """Returns the names of every command line tool to probe for."""
+    names = set(PROBED_TOOLS)
+    for optimizer in Optimizer.__metaclass__.REGISTRY.values():
+        names.update(optimizer.tools)
+    return sorted(names)
+
+
+def probe_tools(names):
+    """
+    Looks for each command line tool on the PATH. Returns a dict of tool
+    name to full path, or None for tools that aren't installed.
+    """
+    capabilities = {}
+    for name in names:
+        # forget any earlier fingerprint, in case the tool has changed
+        _tool_fingerprints.pop(name, None)
+        capabilities[name] = which(name)
+        tool_fingerprint(name)
+    return capabilities
+
+
+def which(name):
+    """Returns the full path of executable ``name`` on the PATH, or None."""
+    for dir in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(dir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+_tool_fingerprints = {}
+
+def tool_fingerprint(name):
+    """Identifies the installed version of a command line tool by the path,
+    size and mtime of its binary. This changes whenever the tool is upgraded
+    and, unlike asking the tool for its version, doesn't need a fork.
+    """
+    if name not in _tool_fingerprints:
+        path = which(name)
+        if path is None:
+            _tool_fingerprints[name] = 'missing'
+        else:
+            st = os.stat(path)
+            _tool_fingerprints[name] = '%s:%d:%d' % (path, st.st_size, int(st.st_mtime))
+    return _tool_fingerprints[name]
+
+
 @contextmanager
 def working_directory(path):
     """A context manager which changes the working directory to the given
@@ -215,8 +1213,635 @@ def RegistryMetaclass(clazz=None, attribute=None, allow_none=True, desc=None):
 
 
 
+class OptimizeJob(object):
+    """
+    Handle for an optimization queued with ``Optimize.enqueue``
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, file, output=None):
+        self.file = file
+        self.output = output
+        self.status = OptimizeJob.PENDING
+        # the output path once done
+        self.result = None
+        # the exception if the job failed
+        self.error = None
+        self._finished = threading.Event()
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the job has finished, returning False on timeout
+        """
+        self._finished.wait(timeout)
+        return self._finished.is_set()
+
+    def run(self, optimize):
+        self.status = OptimizeJob.RUNNING
+        try:
+            self.result = optimize.smush(self.file, self.output)
+            self.status = OptimizeJob.DONE
+        except Exception, e:
+            current_app.logger.exception("Unable to optimize %s", self.file)
+            self.error = e
+            self.status = OptimizeJob.FAILED
+        finally:
+            self._finished.set()
+
+
+class JobQueue(object):
+    """
+    Bounded queue of ``OptimizeJob``s, worked by a pool of daemon threads.
+    Each job is run by ``optimize`` in an app context for ``app``.
+
+    Threads don't survive a fork, so a process forked after the workers
+    were started (e.g. a preloaded gunicorn worker) starts its own, with an
+    empty queue, on its first ``put``.
+    """
+
+    def __init__(self, app, optimize, workers, maxsize=0):
+        self.app = app
+        self.optimize = optimize
+        self.workers = workers
+        self.queue = Queue.Queue(maxsize)
+        self.threads = []
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.pid = os.getpid()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='optimize-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, job, block=True, timeout=None):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # the parent's jobs are its own to run
+                    self.queue = Queue.Queue(self.queue.maxsize)
+                    self.threads = []
+                    self.start()
+        self.queue.put(job, block, timeout)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers once every job already queued has been run. With
+        ``wait``, blocks until they have all finished.
+        """
+        if self.pid != os.getpid():
+            # the workers are the parent's, not this process's
+            return
+        threads, self.threads = self.threads, []
+        for thread in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    break
+                with self.app.app_context():
+                    job.run(self.optimize)
+            finally:
+                self.queue.task_done()
+
+
+class Metrics(object):
+    """
+    Thread-safe counters and histograms, labelled by keyword arguments (e.g.
+    ``format`` or ``command``)
+    """
+
+    # histogram bucket upper bounds, in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def _labels(self, labels):
+        return ','.join('%s=%s' % item for item in sorted(labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(self.buckets)}
+                self.histograms[name][key] = histogram
+            histogram['count'] += 1
+            histogram['sum'] += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+
+    def snapshot(self):
+        """
+        Returns a copy of the metrics as
+        ``{'counters': {name: {labels: value}}, 'histograms': {name: {labels:
+        {'count', 'sum', 'buckets': [(upper bound, cumulative count)]}}}}``,
+        where labels is a string like ``'format=PNG'``
+        """
+        with self.lock:
+            counters = dict((name, dict(values)) for name, values in self.counters.items())
+            histograms = dict((name, dict((key, {
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'buckets': zip(self.buckets, histogram['buckets'])
+            }) for key, histogram in values.items())) for name, values in self.histograms.items())
+        return {'counters': counters, 'histograms': histograms}
+
+    def timed(self, run):
+        """
+        Wraps a ``run_command``-like function so each command's wall time,
+        failures and piped bytes are recorded, labelled by tool name
+        """
+        def timed_run(args, input=None, deadline=None):
+            command = os.path.basename(args[0])
+            start = time.time()
+            result = run(args, input, deadline)
+            returncode, stdout, stderr = result
+            self.incr('command_invocations', command=command)
+            self.observe('command_seconds', time.time() - start, command=command)
+            if returncode != 0:
+                self.incr('command_failures', command=command)
+            if input is not None:
+                self.incr('command_bytes_in', len(input), command=command)
+                self.incr('command_bytes_out', len(stdout), command=command)
+            return result
+        return timed_run
+
+
+class ResultCache(object):
+    """
+    Content-addressed store of optimized images. Entries are kept under
+    ``path`` as ``<key[:2]>/<key>``, where the key is built by the caller from
+    a hash of the input bytes and the pipeline config.
+
+    With ``max_bytes``, accesses are recorded in a ``CacheIndex`` and the
+    least recently (``lru``) or least frequently (``lfu``) used entries are
+    evicted to keep the cache under that size.
+    """
+
+    def __init__(self, path, max_bytes=None, eviction='lru'):
+        self.path = path
+        self.index = None
+        if max_bytes is not None:
+            self.index = CacheIndex(self, max_bytes, eviction)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key, output):
+        """
+        Copies the cached result for ``key`` to ``output``. Returns False on
+        a cache miss.
+        """
+        entry = self._entry_path(key)
+        if not os.path.isfile(entry):
+            return False
+        try:
+            copy_file(entry, output, output if os.path.exists(output) else None)
+        except (IOError, OSError):
+            # it may have just been evicted
+            current_app.logger.error("Unable to copy %s to %s", entry, output)
+            return False
+        if self.index is not None:
+            self.index.touch(key)
+        return True
+
+    def get_bytes(self, key):
+        """
+        Returns the cached result for ``key``, or None on a cache miss.
+        """
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        if self.index is not None:
+            self.index.touch(key)
+        return data
+
+    def put(self, key, path):
+        """
+        Stores the file at ``path`` as the result for ``key``.
+        """
+        self._store(key, lambda temp: shutil.copyfile(path, temp))
+
+    def put_bytes(self, key, data):
+        """
+        Stores ``data`` as the result for ``key``.
+        """
+        def write(temp):
+            with open(temp, 'wb') as f:
+                f.write(data)
+        self._store(key, write)
+
+    def _store(self, key, write):
+        """
+        Calls ``write`` with a temp file path to fill, then renames the temp
+        file into place, so concurrent readers never see a partial entry.
+        """
+        entry = self._entry_path(key)
+        dir = os.path.dirname(entry)
+        if not os.path.isdir(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                # another worker may have created it in the meantime
+                if not os.path.isdir(dir):
+                    raise
+        fd, temp = tempfile.mkstemp(dir=dir)
+        os.close(fd)
+        try:
+            write(temp)
+            size = os.path.getsize(temp)
+            _replace(temp, entry)
+        except (IOError, OSError):
+            current_app.logger.error("Unable to store %s in the result cache", key)
+            if os.path.exists(temp):
+                os.unlink(temp)
+            return
+
+        if self.index is not None:
+            self.index.add(key, size)
+
+
+class HotCache(object):
+    """
+    In-process LRU of optimized images ready to serve, as
+    ``(body, mimetype, etag)`` tuples, bounded by the total size of their
+    bodies.
+
+    With ``shared_path`` (a directory on a tmpfs such as ``/dev/shm``),
+    entries are also written there, so the other worker processes on the
+    machine can pick them up without optimizing or going to the result
+    cache. Each process removes the files it wrote as it evicts them and
+    when it exits. Files left by processes that were killed are swept up
+    once they go unused for ``max_age`` seconds, and the oldest files are
+    removed once the directory holds more than ``shared_max_bytes``.
+    """
+
+    # seconds a shared file may go unread before any process removes it
+    max_age = 3600
+
+    # seconds between sweeps of shared_path
+    sweep_interval = 60
+
+    def __init__(self, max_bytes, shared_path=None, shared_max_bytes=None):
+        self.max_bytes = max_bytes
+        self.shared_path = shared_path
+        self.shared_max_bytes = shared_max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # keys of the entries this process wrote to shared_path
+        self.owned = set()
+        self.pid = os.getpid()
+        self.swept = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the entry for ``key``, or None if it isn't cached
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                return entry
+
+        if self.shared_path is not None:
+            entry = self._load(key)
+            if entry is not None:
+                self._add(key, entry)
+        return entry
+
+    def put(self, key, body, mimetype, etag):
+        """
+        Caches ``body`` with its ``mimetype`` and ``etag``, unless it's
+        bigger than the whole cache
+        """
+        if len(body) > self.max_bytes:
+            return
+        entry = (body, mimetype, etag)
+        self._add(key, entry)
+        if self.shared_path is not None:
+            self._save(key, entry)
+            self._sweep()
+
+    def close(self):
+        """
+        Removes the files this process wrote to ``shared_path``
+        """
+        with self.lock:
+            owned = self._get_owned()
+            self.owned = set()
+        for key in owned:
+            self._unlink(key)
+
+    def _add(self, key, entry):
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = entry
+            self.size += len(entry[0])
+            while self.size > self.max_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self.size -= len(old[0])
+                owned = self._get_owned()
+                if old_key in owned:
+                    owned.discard(old_key)
+                    evicted.append(old_key)
+
+        for key in evicted:
+            self._unlink(key)
+
+    def _get_owned(self):
+        """
+        Returns the keys this process wrote to ``shared_path``; a forked
+        process starts with none of its parent's. Called with ``self.lock``
+        held.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.owned = set()
+        return self.owned
+
+    def _unlink(self, key):
+        try:
+            os.unlink(os.path.join(self.shared_path, key))
+        except OSError:
+            pass
+
+    def _load(self, key):
+        path = os.path.join(self.shared_path, key)
+        try:
+            with open(path, 'rb') as f:
+                mimetype, etag, body = f.read().split('\n', 2)
+            # keep it from being swept while it's in use
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return body, mimetype, etag
+
+    def _save(self, key, entry):
+        body, mimetype, etag = entry
+        path = os.path.join(self.shared_path, key)
+        try:
+            temp = make_temp_file(path)
+            with open(temp, 'wb') as f:
+                f.write('%s\n%s\n' % (mimetype, etag))
+                f.write(body)
+            replace_file(temp, path)
+        except (IOError, OSError):
+            current_app.logger.error("Unable to share %s in %s", key, self.shared_path)
+            return
+        with self.lock:
+            if key in self.entries:
+                self._get_owned().add(key)
+            else:
+                # evicted while being written
+                os.unlink(path)
+
+    def _sweep(self):
+        """
+        Removes the files in ``shared_path`` unused for ``max_age`` seconds,
+        then the least recently used until the rest fit in
+        ``shared_max_bytes``, whichever process wrote them. Runs at most once
+        every ``sweep_interval`` seconds.
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.swept < self.sweep_interval:
+                return
+            self.swept = now
+
+        files = []
+        try:
+            names = os.listdir(self.shared_path)
+        except OSError:
+            return
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.shared_path, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+
+        # newest first, so whatever is over the limit is the oldest
+        files.sort(reverse=True)
+        total = 0
+        for mtime, size, name in files:
+            if now - mtime <= self.max_age:
+                if name.startswith('.'):
+                    # another process's temp file, still being written
+                    continue
+                total += size
+                if self.shared_max_bytes is None or total <= self.shared_max_bytes:
+                    continue
+            self._unlink(name)
+            with self.lock:
+                self._get_owned().discard(name)
+
+
+class CacheIndex(object):
+    """
+    Size and access record of the entries in a ``ResultCache``, kept in a
+    SQLite database in the cache directory so every process using the cache
+    shares it. Once the entries add up to more than ``max_bytes``, the least
+    recently or least frequently used (by ``policy``) are evicted until
+    they're back under ``low_water`` of it.
+
+    Only one process evicts at a time; the others carry on serving and
+    storing entries meanwhile. An entry evicted while being read is simply a
+    cache miss.
+    """
+
+    policies = ('lru', 'lfu')
+
+    # seconds between recording accesses to the same entry, so cache hits
+    # rarely need to write to the index
+    touch_interval = 60
+
+    # fraction of max_bytes that eviction brings the cache down to
+    low_water = 0.9
+
+    def __init__(self, cache, max_bytes, policy='lru'):
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.path = os.path.join(cache.path, 'index.db')
+        self.lock = threading.Lock()
+        self.pid = None
+        self.touched = {}
+
+    def _connect(self):
+        """
+        Returns this process's connection to the index, opening it (and
+        indexing any entries already on disk) on first use. Called with
+        ``self.lock`` held.
+        """
+        if self.pid == os.getpid():
+            return self.db
+
+        if not os.path.isdir(self.cache.path):
+            try:
+                os.makedirs(self.cache.path)
+            except OSError:
+                if not os.path.isdir(self.cache.path):
+                    raise
+        # autocommit, with transactions begun explicitly
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                             check_same_thread=False)
+        # lets readers carry on while another process writes
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER,
+                last_access REAL,
+                hits INTEGER)""")
+            db.execute('CREATE TABLE IF NOT EXISTS total (bytes INTEGER)')
+            if db.execute('SELECT bytes FROM total').fetchone() is None:
+                entries = list(self._scan())
+                db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, 0)', entries)
+                db.execute('INSERT INTO total VALUES (?)', (sum(entry[1] for entry in entries),))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+        self.db = db
+        self.pid = os.getpid()
+        self.touched = {}
+        return db
+
+    def _scan(self):
+        """
+        Yields ``(key, size, last access)`` for the entries on disk
+        """
+        for dir in os.listdir(self.cache.path):
+            dir = os.path.join(self.cache.path, dir)
+            if not os.path.isdir(dir):
+                continue
+            for key in os.listdir(dir):
+                st = os.stat(os.path.join(dir, key))
+                yield key, st.st_size, st.st_mtime
+
+    def touch(self, key):
+        """
+        Records a cache hit for ``key``
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.touched.get(key, 0) < self.touch_interval:
+                return
+            if len(self.touched) > 10000:
+                self.touched.clear()
+            self.touched[key] = now
+            self._connect().execute(
+                'UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?', (now, key))
+
+    def add(self, key, size):
+        """
+        Records a new entry of ``size`` bytes, evicting others if the cache
+        is now too big
+        """
+        now = time.time()
+        with self.lock:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, 0)', (key, size, now))
+                db.execute('UPDATE total SET bytes = bytes + ?', (size - (row[0] if row else 0),))
+                total = db.execute('SELECT bytes FROM total').fetchone()[0]
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+            self.touched[key] = now
+
+        if total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes entries, least used first, until the cache is under
+        ``low_water`` of ``max_bytes``. Returns without doing anything if
+        another process is already evicting.
+        """
+        lock = open(os.path.join(self.cache.path, '.lock'), 'a')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    return
+
+            if self.policy == 'lfu':
+                order = 'hits, last_access'
+            else:
+                order = 'last_access'
+
+            with self.lock:
+                db = self._connect()
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    total = db.execute('SELECT bytes FROM total').fetchone()[0]
+                    target = self.max_bytes * self.low_water
+                    evicted = []
+                    cursor = db.execute('SELECT key, size FROM entries ORDER BY ' + order)
+                    for key, size in cursor:
+                        if total <= target:
+                            break
+                        evicted.append(key)
+                        total -= size
+                    cursor.close()
+
+                    db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in evicted])
+                    db.execute('UPDATE total SET bytes = ?', (total,))
+                    for key in evicted:
+                        try:
+                            os.unlink(self.cache._entry_path(key))
+                        except OSError:
+                            pass
+                    db.execute('COMMIT')
+                except:
+                    db.execute('ROLLBACK')
+                    raise
+        finally:
+            lock.close()
+
+        current_app.logger.debug("Evicted %d entries from the result cache", len(evicted))
+
 
-            
 class Optimizer(object):
     """
     Super-class for optimizers
@@ -228,13 +1853,22 @@ class Optimizer(object):
     
     input_placeholder = "__INPUT__"
     output_placeholder = "__OUTPUT__"
+
+    # command line tools used by this optimizer
+    tools = ()
+
+    # the format this optimizer encodes to, if it isn't the input's
+    output_format = None
+
+    # speed/size presets, from quickest to smallest output
+    levels = ('fast', 'balanced', 'max')
     
     
     def __init__(self, **kwargs):
         # the number of times the _get_command iterator has been run
         self.quiet = kwargs.get('quiet')
-        self.stdout = Scratch()
-        self.stderr = Scratch()
+        # the command that produced the output, when alternatives are raced
+        self.winner = None
     
 
     def _replace_placeholders(self, command, input, output):
@@ -249,149 +1883,681 @@ class Optimizer(object):
         Optimizes an image
         """
         raise NotImplementedError()
+
+    def get_stream_commands(self):
+        """
+        Returns the commands used by ``squish_bytes``. Commands without input
+        and output placeholders read the image from stdin and write the
+        result to stdout.
+        """
+        raise NotImplementedError()
+
+    def squish_bytes(self, data):
+        """
+        Optimizes an image held in memory, returning the optimized bytes.
+        Each command is run on the smallest result so far; commands that
+        can't stream go through a pair of scratch files.
+        """
+        scratch = None
+        deadline = self._get_deadline()
+        try:
+            for command in self.get_stream_commands():
+                if self._out_of_time(deadline):
+                    break
+
+                if Optimizer.input_placeholder in command:
+                    if scratch is None:
+                        scratch = (self._make_scratch_file(), self._make_scratch_file())
+                    input, output = scratch
+                    with open(input, 'wb') as f:
+                        f.write(data)
+                    args = shlex.split(self._replace_placeholders(command, input, output))
+                    if not self._run(args, deadline):
+                        continue
+                    with open(output, 'rb') as f:
+                        optimized = f.read()
+                else:
+                    optimized = self._pipe(shlex.split(command), data, deadline)
+
+                if optimized and len(optimized) < len(data):
+                    data = optimized
+        finally:
+            if scratch is not None:
+                for path in scratch:
+                    if os.path.exists(path):
+                        os.unlink(path)
+
+        return data
+
+    def _race(self, commands, path, deadline=None, near=None):
+        """
+        Runs alternative ``commands`` on ``path`` at the same time, each
+        writing its own scratch file (made next to ``near``, if given). Once
+        all have finished (or ``deadline`` passes) returns
+        ``(command, scratch file)`` for the smallest output, or None if every
+        command failed. The caller removes the winning scratch file.
+        """
+        outputs = [self._make_scratch_file(near) for command in commands]
+        args = [shlex.split(self._replace_placeholders(command, path, output))
+                for command, output in zip(commands, outputs)]
+        results = self._run_many(args, None, deadline)
+
+        winner = None
+        for command, output, (returncode, stdout, stderr) in zip(commands, outputs, results):
+            if returncode == 0 and os.path.getsize(output) > 0:
+                if winner is None or os.path.getsize(output) < os.path.getsize(winner[1]):
+                    winner = (command, output)
+
+        for output in outputs:
+            if winner is None or output != winner[1]:
+                os.unlink(output)
+        return winner
+
+    def _race_pipes(self, commands, data, deadline=None):
+        """
+        Pipes ``data`` through alternative streaming ``commands`` at the same
+        time. Returns ``(command, output)`` for the smallest output, or None
+        if every command failed.
+        """
+        results = self._run_many([shlex.split(command) for command in commands], data, deadline)
+        outputs = [(command, stdout) for command, (returncode, stdout, stderr)
+                   in zip(commands, results) if returncode == 0 and stdout]
+
+        if not outputs:
+            current_app.logger.debug("Every command failed: %s", ', '.join(commands))
+            return None
+        return min(outputs, key=lambda result: len(result[1]))
+
+    def _make_scratch_file(self, near=None):
+        return make_temp_file(near)
+
+    def _get_runner(self):
+        """
+        Returns the function that launches commands: the app's spawn helper
+        if ``OPTIMIZE_SPAWN_HELPER`` is on, otherwise ``run_command``, timed
+        by the app's metrics
+        """
+        optimize = getattr(current_app, 'optimize', None)
+        if optimize is None:
+            return run_command
+        if optimize.spawner is not None:
+            return optimize.stats.timed(optimize.spawner.run)
+        return optimize.stats.timed(run_command)
+
+    def _pipe(self, args, data, deadline=None):
+        """
+        Runs a command with ``data`` on stdin, returning its stdout, or None
+        if the command failed or ran past ``deadline``
+        """
+        returncode, stdout, stderr = self._get_runner()(args, data, deadline)
+        if returncode is None:
+            current_app.logger.error("Error executing command %s. Error was %s", args[0], stderr)
+            return None
+        if returncode != 0:
+            current_app.logger.debug("%s failed: %s", args[0], stderr.strip())
+            return None
+        return stdout
         
         
-    def _run(self, args):
-        try:
-            # retcode = subprocess.call(args, stdout=self.stdout.opened, stderr=self.stderr.opened)
-            retcode = subprocess.call(args)
-        except OSError:
-            current_app.logger.error("Error executing command %s. Error was %s" % (command, OSError))
+    def _run(self, args, deadline=None):
+        """
+        Runs a command, returning whether it succeeded before ``deadline``
+        """
+        returncode, stdout, stderr = self._get_runner()(args, None, deadline)
+        if returncode is None:
+            current_app.logger.error("Error executing command %s. Error was %s", args[0], stderr)
+            return False
 
-        if retcode != 0:
+        if returncode != 0:
             # gifsicle seems to fail by the file size?
             # os.unlink(output)
             return False
         else :
             return True
 
+    def _run_many(self, commands, input=None, deadline=None):
+        """
+        Runs several commands at the same time, each given ``input`` on
+        stdin. Returns a ``(returncode, stdout, stderr)`` tuple per command.
+        """
+        run = self._get_runner()
+        results = [None] * len(commands)
+
+        def work(i):
+            try:
+                results[i] = run(commands[i], input, deadline)
+            except Exception, e:
+                # as if the command couldn't be started
+                results[i] = (None, '', str(e))
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(len(commands))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for args, (returncode, stdout, stderr) in zip(commands, results):
+            if returncode is None:
+                current_app.logger.error("Error executing command %s. Error was %s", args[0], stderr)
+        return results
+
+    def _get_deadline(self):
+        """
+        Returns the time by which optimizing the current file must finish
+        under ``OPTIMIZE_TIME_BUDGET``, or None if there's no budget
+        """
+        budget = current_app.config['OPTIMIZE_TIME_BUDGET']
+        if budget is None:
+            return None
+        return time.time() + budget
+
+    def _out_of_time(self, deadline):
+        if deadline is not None and time.time() >= deadline:
+            current_app.logger.debug("Time budget used up, keeping the best result so far")
+            return True
+        return False
+
                 
-    def _keep_smallest_file(self, input, output):
+    def _keep_smallest_file(self, input, output, original):
         """
-        Compares the sizes of two files, and discards the larger one
+        Compares the sizes of two files, and discards the larger one (but
+        never ``original``). Returns the path of the file kept.
         """
         input_size = os.path.getsize(input)
         output_size = os.path.getsize(output)
 
-        # save the smaller file to the output path
-        if (output_size > input_size):
-            try:
-                shutil.copyfile(input, output)
-            except IOError:
-                current_app.logger.error("Unable to copy %s to %s: %s" % (input, output, IOError))
+        if (output_size > 0 and output_size < input_size):
+            if input != original:
+                os.unlink(input)
+            return output
 
         # delete the output file
         os.unlink(output)
+        return input
+
+    def _save(self, path, best, output):
+        """
+        Writes the best file found for ``path`` to ``output``. This is the
+        only time the output is written, however many stages ran, and it's
+        done with an atomic rename so nothing reading ``output`` sees a
+        partial image.
+        """
+        mode_from = output if os.path.exists(output) else path
+        if best != path:
+            try:
+                replace_file(best, output, mode_from)
+            except (IOError, OSError):
+                current_app.logger.error("Unable to move %s to %s", best, output)
+                if os.path.exists(best):
+                    os.unlink(best)
+        elif output != path:
+            copy_file(path, output, mode_from)
         
 get_optimizer = Optimizer.resolve
 
 
+def run_command(args, input=None, deadline=None):
+    """
+    Runs a command to completion, feeding it ``input`` on stdin if given,
+    and killing it if it's still running at ``deadline``. Returns
+    ``(returncode, stdout, stderr)``; the return code is None if the command
+    couldn't be started, with the reason in place of stderr.
+    """
+    try:
+        process = subprocess.Popen(args, stdin=subprocess.PIPE if input is not None else None,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, e:
+        return None, '', str(e)
+
+    timer = None
+    if deadline is not None:
+        timer = threading.Timer(max(0, deadline - time.time()), _kill, (process,))
+        timer.start()
+    try:
+        stdout, stderr = process.communicate(input)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    return process.returncode, stdout, stderr
+
+
+def _kill(process):
+    try:
+        process.kill()
+    except OSError:
+        # already finished
+        pass
+
+
+class SpawnHelper(object):
+    """
+    Small, long-lived process that launches the optimization tools for the
+    app. It is forked once, while the app's heap is still small, so starting
+    a tool costs the same however large the web worker grows. Commands are
+    sent over a pipe and run concurrently, each in its own thread.
+
+    A helper belongs to the process that started it; after a fork (e.g. into
+    preloaded gunicorn workers) each process starts its own on first use,
+    which is forked from that process at whatever size it has grown to. The
+    helper exits when its parent does, even if the parent is killed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.start()
+
+    def start(self):
+        import multiprocessing
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_spawn_helper_main,
+                                               args=(child, self.conn, os.getpid()),
+                                               name='optimize-spawn-helper')
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+        self.pid = os.getpid()
+        self.ids = itertools.count()
+        self.pending = {}
+        reader = threading.Thread(target=self._read, args=(self.conn,),
+                                  name='optimize-spawn-reader')
+        reader.daemon = True
+        reader.start()
+
+    def run(self, args, input=None, deadline=None):
+        """
+        Runs a command in the helper, with the same arguments and result as
+        ``run_command``
+        """
+        finished = threading.Event()
+        job = {}
+        with self.lock:
+            if self.pid != os.getpid():
+                self.start()
+            id = next(self.ids)
+            self.pending[id] = (finished, job)
+            try:
+                self.conn.send((id, args, input, deadline))
+            except (IOError, OSError), e:
+                del self.pending[id]
+                return None, '', 'Spawn helper unavailable: %s' % e
+        finished.wait()
+        return job['result']
+
+    def close(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                try:
+                    self.conn.send(None)
+                except (IOError, OSError):
+                    pass
+                self.process.join(1)
+
+    def _read(self, conn):
+        while True:
+            try:
+                id, result = conn.recv()
+            except (EOFError, IOError, OSError):
+                break
+            with self.lock:
+                finished, job = self.pending.pop(id)
+            job['result'] = result
+            finished.set()
+
+        # the helper has gone, so fail anything still waiting on it
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for finished, job in pending.values():
+            job['result'] = (None, '', 'Spawn helper exited')
+            finished.set()
+
+
+def _spawn_helper_main(conn, parent_conn, parent):
+    # the fork inherits the parent's end of the pipe; close it, so the pipe
+    # reports EOF once the parent has gone
+    parent_conn.close()
+    lock = threading.Lock()
+
+    def work(id, args, input, deadline):
+        result = run_command(args, input, deadline)
+        with lock:
+            conn.send((id, result))
+
+    while True:
+        try:
+            # the parent's end may also be held open by processes forked from
+            # it, so check now and then that the parent is still there
+            if not conn.poll(1):
+                if os.getppid() != parent:
+                    break
+                continue
+            job = conn.recv()
+        except (EOFError, IOError):
+            break
+        if job is None:
+            break
+        thread = threading.Thread(target=work, args=job)
+        thread.daemon = True
+        thread.start()
+
+
 class PNGOptimizer(Optimizer):
     id = 'PNG'
+    tools = ('pngnq', 'pngcrush')
     
+    # pngcrush options for each level: a single method, pngcrush's default
+    # handful of methods, or every filter/zlib combination
+    pngcrush_options = {
+        'fast': '-m 1 ',
+        'balanced': '',
+        'max': '-brute '
+    }
+
     @classmethod
-    def get_commands(cls, quiet=False):
-        if quiet:
-            pngcrush = 'pngcrush -rem alla -brute -reduce -q "__INPUT__" "__OUTPUT__"'
-        else:
-            pngcrush = 'pngcrush -rem alla -brute -reduce "__INPUT__" "__OUTPUT__"'
+    def get_commands(cls, quiet=False, level='max'):
+        pngcrush = 'pngcrush -rem alla %s-reduce %s"__INPUT__" "__OUTPUT__"' % (
+            cls.pngcrush_options[level], '-q ' if quiet else '')
             
         return ('pngnq -n 256 -o "__OUTPUT__" "__INPUT__"', pngcrush)
+
+    def get_stream_commands(self):
+        # pngnq quantises stdin to stdout, but pngcrush only works on files
+        return ('pngnq -n 256',
+                self.get_commands(quiet=True, level=current_app.config['OPTIMIZE_LEVEL'])[1])
         
     def squish(self, path, output=None):
-        commands = self.get_commands(quiet=True)
-        
-        # OOPS!! Need to set the "path" to the optimized image so it gets processed again on each loop
+        commands = self.get_commands(quiet=True, level=current_app.config['OPTIMIZE_LEVEL'])
+        deadline = self._get_deadline()
+
+        # each stage works on the smallest file so far, kept in a scratch file
+        # until every stage has run
+        best = path
         
         for command in commands:
-            command = self._replace_placeholders(command, path, output)
+            if self._out_of_time(deadline):
+                break
+
+            candidate = self._make_scratch_file(output)
+            command = self._replace_placeholders(command, best, candidate)
             args = shlex.split(command)
             
-            optimized = self._run(args)
-            
-            if optimized:
+            if self._run(args, deadline):
                 # compare file sizes if the command executed successfully
-                self._keep_smallest_file(path, output)
+                best = self._keep_smallest_file(best, candidate, path)
+            else:
+                os.unlink(candidate)
+
+        self._save(path, best, output)
         
         
 class JPGOptimizer(Optimizer):
     id = 'JPEG'
+    tools = ('jpegtran',)
     
     @classmethod
-    def get_commands(cls, strip_meta=True):
+    def get_commands(cls, strip_meta=True, level='max'):
         if strip_meta:
-            return ('jpegtran -outfile "__OUTPUT__" -optimise -copy none "__INPUT__"',
+            commands = ('jpegtran -outfile "__OUTPUT__" -optimise -copy none "__INPUT__"',
                 'jpegtran -outfile "__OUTPUT__" -optimise -progressive "__INPUT__"')
         else:
-            return ('jpegtran -outfile "__OUTPUT__" -optimise -copy all "__INPUT__"',
+            commands = ('jpegtran -outfile "__OUTPUT__" -optimise -copy all "__INPUT__"',
                 'jpegtran -outfile "__OUTPUT__" -optimise -progressive -copy all "__INPUT__"')
 
+        # the fast level skips trying a progressive encoding
+        if level == 'fast':
+            return commands[:1]
+        return commands
+
+    def get_stream_commands(self):
+        # jpegtran reads stdin and writes stdout when given no file names
+        if current_app.config['OPTIMIZE_STRIP_META']:
+            commands = ('jpegtran -optimise -copy none',
+                'jpegtran -optimise -progressive -copy none')
+        else:
+            commands = ('jpegtran -optimise -copy all',
+                'jpegtran -optimise -progressive -copy all')
+
+        if current_app.config['OPTIMIZE_LEVEL'] == 'fast':
+            return commands[:1]
+        return commands
+
     def squish(self, path, output=None):
-        commands = self.get_commands(strip_meta=True)
-        
-        # OOPS!! Need to set the "path" to the optimized image so it gets processed again on each loop
-        
-        for command in commands:
-            command = self._replace_placeholders(command, path, output)
-            args = shlex.split(command)
-            
-            optimized = self._run(args)
-            
-            if os.path.getsize(output) > 10000:
-                current_app.logger.warning("File is > 10kb - will be converted to progressive")
-                continue
-            else:
-                if optimized:
-                    # compare file sizes if the command executed successfully
-                    self._keep_smallest_file(path, output)
-                break
-                
+        """
+        Runs the baseline and progressive encodings at the same time and
+        keeps whichever is smallest
+        """
+        commands = self.get_commands(strip_meta=current_app.config['OPTIMIZE_STRIP_META'],
+                                     level=current_app.config['OPTIMIZE_LEVEL'])
+        winner = self._race(commands, path, self._get_deadline(), output)
 
-                
+        best = path
+        if winner is not None:
+            best = self._keep_smallest_file(path, winner[1], path)
+            if best != path:
+                self.winner = winner[0]
+                current_app.logger.debug("%s won for %s", self.winner, path)
 
+        self._save(path, best, output)
 
+    def squish_bytes(self, data):
+        """
+        Pipes ``data`` through the baseline and progressive encodings at the
+        same time and returns whichever is smallest
+        """
+        winner = self._race_pipes(self.get_stream_commands(), data, self._get_deadline())
+        if winner is not None and len(winner[1]) < len(data):
+            self.winner = winner[0]
+            return winner[1]
+        return data
 
+    
+class PillowOptimizer(Optimizer):
+    """
+    Re-encodes images in-process with Pillow, for when the command line
+    tools aren't installed or forking them costs more than the work itself.
+    PNGs and static GIFs are re-encoded losslessly, reducing PNGs to a
+    palette when they have 256 colours or fewer. JPEGs are re-encoded with their original
+    quantization tables, which is as close to lossless as Pillow gets but
+    still changes pixels, so they are only re-encoded with
+    ``OPTIMIZE_BACKEND = 'pillow'``.
+    """
+    id = 'PILLOW'
 
-### scratch.py
-import os, sys, tempfile
+    # formats this optimizer can handle
+    formats = ('PNG', 'JPEG', 'GIF')
 
-class Scratch (object):
-    def __init__ (self):
-        tup = tempfile.mkstemp()
-        self._path = tup[1]
-        self._file = os.fdopen(tup[0])        
-        self._file.close()
+    # formats it can't re-encode without changing pixels, which the auto
+    # backend won't fall back to it for
+    lossy_formats = ('JPEG',)
 
-    def __del__ (self):
-        if self._path != None:
-            self.destruct()
+    def squish(self, path, output=None):
+        with open(path, 'rb') as f:
+            data = f.read()
 
-    def destruct (self):
-        self.close()
-        os.unlink(self._path)
-        self._path = None
-        self._file = None
+        optimized = self.squish_bytes(data)
 
-    def close (self):
-        if self._file.closed == False:
-            self._file.flush()
-            self._file.close()
+        if optimized is not data or output != path:
+            temp = self._make_scratch_file(output)
+            with open(temp, 'wb') as f:
+                f.write(optimized)
+            replace_file(temp, output, output if os.path.exists(output) else path)
 
-    def read (self):
-        if self._file.closed == True:
-            self._reopen()
-        self._file.seek(0)
-        return self._file.read()
+    def squish_bytes(self, data):
+        """
+        Returns the smallest encoding of ``data``, or ``data`` itself if no
+        encoding is smaller
+        """
+        try:
+            img = _import_image().open(io.BytesIO(data))
+            img.load()
+            candidates = getattr(self, '_encode_' + img.format.lower())(img)
+        except (IOError, AttributeError), e:
+            current_app.logger.debug("Unable to re-encode image: %s", e)
+            return data
+
+        for candidate in candidates:
+            if len(candidate) < len(data):
+                data = candidate
+        return data
+
+    def _encode(self, img, format, **kwargs):
+        buffer = io.BytesIO()
+        img.save(buffer, format, **kwargs)
+        return buffer.getvalue()
+
+    def _encode_png(self, img):
+        # an opaque alpha channel can be dropped without losing anything
+        if img.mode == 'RGBA' and img.getextrema()[3] == (255, 255):
+            img = img.convert('RGB')
+
+        candidates = [self._encode(img, 'PNG', optimize=True)]
+
+        palette = self._to_palette(img)
+        if palette is not None:
+            candidates.append(self._encode(palette, 'PNG', optimize=True))
+        return candidates
+
+    def _to_palette(self, img):
+        """
+        Returns ``img`` as a palette image with exactly the same pixels, or
+        None if it has more than 256 colours. A transparent colour
+        (``img.info['transparency']``) is kept as the matching palette entry.
+        """
+        if img.mode not in ('RGB', 'L'):
+            return None
 
-    def _reopen (self):
-        self._file = open(self._path, 'w+')
+        rgb = img.convert('RGB')
+        rgb.info.pop('transparency', None)
+        colors = rgb.getcolors(256)
+        if colors is None:
+            return None
 
-    def getopened (self):
-        self.close()
-        self._reopen()
-        return self._file
-    opened = property(getopened, NotImplemented, NotImplemented, "opened file - read only")
+        Image = _import_image()
+        try:
+            from PIL import ImageChops
+        except ImportError:
+            import ImageChops
+
+        # with no more colours than palette entries, the adaptive palette
+        # holds every colour exactly; check anyway rather than lose detail
+        palette = rgb.convert('P', palette=Image.ADAPTIVE, colors=len(colors))
+
+        key = img.info.get('transparency')
+        if key is not None:
+            if img.mode == 'L':
+                key = (key, key, key)
+            entries = palette.getpalette()
+            for index in range(len(colors)):
+                if tuple(entries[index * 3:index * 3 + 3]) == tuple(key):
+                    palette.info['transparency'] = index
+                    break
+
+        # compare with alpha, so a lost transparent colour shows up too
+        if ImageChops.difference(palette.convert('RGBA'),
+                                 img.convert('RGBA')).getbbox() is not None:
+            return None
+        return palette
+
+    def _encode_jpeg(self, img):
+        kwargs = {'quality': 'keep', 'optimize': True}
+        if not current_app.config['OPTIMIZE_STRIP_META']:
+            for key in ('exif', 'icc_profile'):
+                if key in img.info:
+                    kwargs[key] = img.info[key]
+
+        candidates = [self._encode(img, 'JPEG', **kwargs)]
+        if current_app.config['OPTIMIZE_LEVEL'] != 'fast':
+            candidates.append(self._encode(img, 'JPEG', progressive=True, **kwargs))
+        return candidates
+
+    def _encode_gif(self, img):
+        # re-saving animations can lose per-frame timings, so leave them be
+        if count_frames(img) > 1:
+            return []
+        return [self._encode(img, 'GIF', optimize=True)]
+
+
+class WebPOptimizer(Optimizer):
+    """
+    Encodes PNGs and JPEGs as WebP, for clients that accept it. PNGs are
+    encoded losslessly and JPEGs at ``OPTIMIZE_WEBP_QUALITY``. Uses cwebp
+    when it's installed, and Pillow otherwise.
+    """
+    id = 'WEBP'
+    tools = ('cwebp',)
+    output_format = 'WEBP'
+
+    # formats this optimizer can encode
+    formats = ('PNG', 'JPEG')
+
+    def get_command(self, format):
+        meta = 'none' if current_app.config['OPTIMIZE_STRIP_META'] else 'all'
+        if format == 'PNG':
+            options = '-lossless'
+        else:
+            options = '-q %d' % current_app.config['OPTIMIZE_WEBP_QUALITY']
+        return 'cwebp -quiet %s -metadata %s "__INPUT__" -o "__OUTPUT__"' % (options, meta)
 
-    def getfile (self):
-        return self._file
-    file = property(getfile, NotImplemented, NotImplemented, "file - read only")
+    def squish(self, path, output=None):
+        """
+        Writes the WebP encoding of ``path`` to ``output``
+        """
+        with open(path, 'rb') as f:
+            webp = self.squish_bytes(f.read())
+        if webp is None:
+            raise OptimizerIndeterminableError()
+
+        temp = self._make_scratch_file(output)
+        with open(temp, 'wb') as f:
+            f.write(webp)
+        replace_file(temp, output, output if os.path.exists(output) else path)
+
+    def squish_bytes(self, data):
+        """
+        Returns the WebP encoding of ``data``, or None if it couldn't be
+        encoded
+        """
+        optimize = getattr(current_app, 'optimize', None)
+        if optimize is not None and optimize.capabilities.get('cwebp'):
+            return self._encode_cwebp(data)
+        return self._encode_pillow(data)
+
+    def _encode_cwebp(self, data):
+        # only the header is read to find the format
+        format = _import_image().open(io.BytesIO(data)).format
+        input, output = self._make_scratch_file(), self._make_scratch_file()
+        try:
+            with open(input, 'wb') as f:
+                f.write(data)
+            command = self._replace_placeholders(self.get_command(format), input, output)
+            if not self._run(shlex.split(command), self._get_deadline()):
+                return None
+            with open(output, 'rb') as f:
+                return f.read() or None
+        finally:
+            os.unlink(input)
+            os.unlink(output)
+
+    def _encode_pillow(self, data):
+        try:
+            img = _import_image().open(io.BytesIO(data))
+            format = img.format
+            img.load()
+            kwargs = {}
+            if format == 'PNG':
+                kwargs['lossless'] = True
+            else:
+                kwargs['quality'] = current_app.config['OPTIMIZE_WEBP_QUALITY']
+            if not current_app.config['OPTIMIZE_STRIP_META'] and 'icc_profile' in img.info:
+                kwargs['icc_profile'] = img.info['icc_profile']
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+
+            buffer = io.BytesIO()
+            img.save(buffer, 'WEBP', **kwargs)
+            return buffer.getvalue()
+        except (IOError, KeyError), e:
+            # KeyError: this Pillow was built without WebP support
+            current_app.logger.debug("Unable to encode WebP: %s", e)
+            return None
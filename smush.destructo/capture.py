@@ -0,0 +1,39 @@
+import os, collections, threading
+
+
+class Capture(object):
+    """
+    Collects what a process writes to one of its pipes in memory, keeping only the last 'limit'
+    bytes. The pipe is drained by a background thread, so a chatty tool can never block on a
+    full pipe while we wait for it.
+    """
+
+    def __init__(self, pipe, limit=65536):
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+        self.thread = threading.Thread(target=self._drain, args=(pipe,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _drain(self, pipe):
+        try:
+            while True:
+                chunk = os.read(pipe.fileno(), 4096)
+                if not chunk:
+                    break
+                self.chunks.append(chunk)
+                self.size += len(chunk)
+                # drop whole chunks that are entirely outside the limit
+                while self.size - len(self.chunks[0]) >= self.limit:
+                    self.size -= len(self.chunks.popleft())
+        finally:
+            pipe.close()
+
+    def read(self, timeout=None):
+        """
+        Waits for the pipe to be closed, or up to 'timeout' seconds, and returns the last 'limit'
+        bytes written to it
+        """
+        self.thread.join(timeout)
+        return ''.join(self.chunks)[-self.limit:]
@@ -0,0 +1,92 @@
+import os, struct, logging
+
+# magic bytes at the start of each supported format, and the name it has in
+# 'identify -format %m' output
+MAGIC = (
+    ('\x89PNG\r\n\x1a\n', 'PNG'),
+    ('\xff\xd8\xff', 'JPEG'),
+    ('GIF87a', 'GIF'),
+    ('GIF89a', 'GIF'),
+)
+
+
+def identify(input):
+    """
+    Returns the image format for a file, as the first six characters of
+    'identify -format %m' would: 'PNG', 'JPEG', 'GIF', or 'GIFGIF' for an
+    animated gif. Returns False if the file isn't a supported image.
+
+    Only the file header (and for gifs, the block structure) is read, so no
+    ImageMagick process is needed.
+    """
+    try:
+        f = open(input, 'rb')
+    except IOError:
+        return False
+
+    try:
+        header = f.read(8)
+        for magic, format in MAGIC:
+            if header.startswith(magic):
+                if format == 'GIF':
+                    f.seek(0)
+                    if _count_gif_frames(f, 2) > 1:
+                        return 'GIFGIF'
+                return format
+    except (IOError, struct.error):
+        logging.warning('Cannot identify file %s.' % (input))
+    finally:
+        f.close()
+
+    return False
+
+
+def _skip_sub_blocks(f):
+    """
+    Skips a sequence of gif data sub-blocks, up to and including the
+    zero-length block terminator
+    """
+    while True:
+        size = f.read(1)
+        if not size or size == '\x00':
+            return
+        f.seek(ord(size), os.SEEK_CUR)
+
+
+def _count_gif_frames(f, limit=None):
+    """
+    Counts the image descriptors in a gif, stopping once 'limit' have been seen
+    """
+    # header and logical screen descriptor
+    f.seek(10)
+    flags = f.read(1)
+    if not flags:
+        raise IOError('truncated gif header')
+    flags = ord(flags)
+    f.seek(2, os.SEEK_CUR)
+    if flags & 0x80:
+        # skip the global colour table
+        f.seek(3 << ((flags & 0x07) + 1), os.SEEK_CUR)
+
+    frames = 0
+    while limit is None or frames < limit:
+        block = f.read(1)
+        if block == '\x2c':
+            # image descriptor: position, size, then the packed flags
+            frames += 1
+            flags = struct.unpack('<4HB', f.read(9))[4]
+            if flags & 0x80:
+                # skip the local colour table
+                f.seek(3 << ((flags & 0x07) + 1), os.SEEK_CUR)
+            # lzw minimum code size, then the image data
+            f.seek(1, os.SEEK_CUR)
+            _skip_sub_blocks(f)
+        elif block == '\x21':
+            # extension: label, then data sub-blocks
+            f.seek(1, os.SEEK_CUR)
+            _skip_sub_blocks(f)
+        else:
+            # trailer, or a truncated file
+            break
+
+    return frames
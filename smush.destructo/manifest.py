@@ -0,0 +1,111 @@
+import os, hashlib, sqlite3, threading, time
+from optimiser.optimiser import Optimiser
+
+
+class Manifest(object):
+    """
+    Persistent record of the files smush has already processed, kept in a
+    SQLite database. Each file is stored with its size, mtime and content
+    hash as they were after it was last optimised, so unchanged files can be
+    skipped on the next run. The level it was optimised at, and whether that
+    finished within the time budget, are stored too, so a quick run doesn't
+    stop a later, more thorough one from trying harder.
+
+    A Manifest can be shared between threads: Smush checks files against it
+    as they're handed to its worker pool while recording the finished ones.
+    """
+
+    # number of records to write between commits
+    commit_interval = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            hash TEXT,
+            bytes_saved INTEGER,
+            optimised_at REAL,
+            level TEXT,
+            complete INTEGER)''')
+        # manifests written before levels were recorded were all optimised at
+        # the default level, with no time budget
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(files)')]
+        if 'level' not in columns:
+            self.db.execute("ALTER TABLE files ADD COLUMN level TEXT DEFAULT 'max'")
+            self.db.execute('ALTER TABLE files ADD COLUMN complete INTEGER DEFAULT 1')
+            self.db.commit()
+        self.pending = 0
+
+    def is_unchanged(self, path, level='max'):
+        """
+        Returns whether a file is the same as when it was last recorded, having
+        been optimised at 'level' or a stronger one within the time budget.
+        Files whose mtime changed but whose size didn't are compared by hash.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, hash, level, complete FROM files '
+                                  'WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] != st.st_size:
+            return False
+        if not row[4] or row[3] not in Optimiser.levels or \
+                Optimiser.levels.index(row[3]) < Optimiser.levels.index(level):
+            return False
+        if row[1] == st.st_mtime:
+            return True
+        return row[2] == hash_file(path)
+
+    def record(self, path, bytes_saved, level='max', complete=True):
+        """
+        Records the current state of a file, the bytes saved optimising it,
+        the level it was optimised at and whether that was completed within the
+        time budget
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+
+        hash = hash_file(path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (os.path.abspath(path), st.st_size, st.st_mtime, hash,
+                             bytes_saved, time.time(), level, int(bool(complete))))
+            self.pending += 1
+            if self.pending >= self.commit_interval:
+                self._commit()
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.db.close()
+
+
+def hash_file(path, blocksize=65536):
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
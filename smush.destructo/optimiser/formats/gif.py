@@ -1,8 +1,7 @@
-import os.path
-import shutil
 from optimiser.optimiser import Optimiser
 from animated_gif import OptimiseAnimatedGIF
-import logging
+from identify import identify
+from png import pngcrush_command
 
 class OptimiseGIF(Optimiser):
     """
@@ -17,10 +16,7 @@ class OptimiseGIF(Optimiser):
         super(OptimiseGIF, self).__init__(**kwargs)
 
         # the command to execute this optimiser
-        if kwargs.get('quiet') == True:
-            pngcrush = 'pngcrush -rem alla -brute -reduce -q "__INPUT__" "__OUTPUT__"'
-        else:
-            pngcrush = 'pngcrush -rem alla -brute -reduce "__INPUT__" "__OUTPUT__"'
+        pngcrush = pngcrush_command(self.level, kwargs.get('quiet') == True)
         self.commands = ('convert "__INPUT__" png:"__OUTPUT__"',
             'pngnq -n 256 -o "__OUTPUT__" "__INPUT__"',
             pngcrush)
@@ -35,8 +31,8 @@ class OptimiseGIF(Optimiser):
         self.format = "GIF"
 
 
-    def set_input(self, input):
-        super(OptimiseGIF, self).set_input(input)
+    def set_input(self, input, format=None):
+        super(OptimiseGIF, self).set_input(input, format)
         self.converted_to_png = False
         self.is_animated = False
 
@@ -45,32 +41,22 @@ class OptimiseGIF(Optimiser):
         """
         Tests an image to see whether it's an animated gif
         """
-        return self.animated_gif_optimiser._is_acceptable_image(input)
+        if self.input_format is None:
+            self.input_format = identify(input)
+        return self.input_format == self.animated_gif_optimiser.format
 
 
     def _keep_smallest_file(self, input, output):
         """
-        Compares the sizes of two files, and discards the larger one
+        Compares the sizes of two files, and discards the larger one. Returns whether the output
+        was kept.
         """
-        input_size = os.path.getsize(input)
-        output_size = os.path.getsize(output)
-        
-        # if the image was optimised (output is smaller than input), overwrite the input file with the output
-        # file.
-        if (output_size < input_size):
-            try:
-                shutil.copyfile(output, input)
-                self.files_optimised += 1
-                self.bytes_saved += (input_size - output_size)
-            except IOError:
-                logging.error("Unable to copy %s to %s: %s" % (output, input, IOError))
-                sys.exit(1)
-
-            if self.iterations == 1 and not self.is_animated:
-                self.converted_to_png = True
-            
-        # delete the output file
-        os.unlink(output)
+        kept = super(OptimiseGIF, self)._keep_smallest_file(input, output)
+
+        if kept and self.iterations == 1 and not self.is_animated:
+            self.converted_to_png = True
+
+        return kept
 
 
     def _get_command(self):
@@ -96,20 +82,3 @@ class OptimiseGIF(Optimiser):
         self.iterations += 1
 
         return command
-
-    def _list_only(self, input, output):
-        """
-        Always keeps input, but still compares the sizes of two files
-        """
-        input_size = os.path.getsize(input)
-        output_size = os.path.getsize(output)
-
-        if (output_size > 0 and output_size < input_size):
-            self.files_optimised += 1
-            self.bytes_saved += (input_size - output_size)
-            self.array_optimised_file.append(input)
-            if self.iterations == 1 and not self.is_animated:
-                self.convert_to_png = True
-        
-        # delete the output file
-        os.unlink(output)
@@ -1,12 +1,12 @@
-import os.path
 from optimiser.optimiser import Optimiser
-import logging
 
 class OptimiseJPG(Optimiser):
     """
-    Optimises jpegs with jpegtran (part of libjpeg)
+    Optimises jpegs with jpegtran (part of libjpeg). The baseline and progressive encodings are
+    run at the same time and the smaller one is kept.
     """
 
+    race = True
 
     def __init__(self, **kwargs):
         super(OptimiseJPG, self).__init__(**kwargs)
@@ -21,25 +21,9 @@ class OptimiseJPG(Optimiser):
             self.commands = ('jpegtran -outfile "__OUTPUT__" -optimise -copy all "__INPUT__"',
                 'jpegtran -outfile "__OUTPUT__" -optimise -progressive -copy all "__INPUT__"')
 
+        # the fast level never tries progressive
+        if self.level == 'fast':
+            self.commands = self.commands[:1]
+
         # format as returned by 'identify'
         self.format = "JPEG"
-
-
-    def _get_command(self):
-        """
-        Returns the next command to apply
-        """
-        # for the first iteration, return the first command
-        if self.iterations == 0:
-            self.iterations += 1
-            return self.commands[0]
-        elif self.iterations == 1:
-            self.iterations += 1
-                        
-            # for the next one, only return the second command if file size > 10kb
-            if os.path.getsize(self.input) > 10000:
-                if self.quiet == False:
-                    logging.warning("File is > 10kb - will be converted to progressive")
-                return self.commands[1]
-
-        return False
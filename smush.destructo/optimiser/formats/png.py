@@ -1,6 +1,21 @@
 import os.path
 from optimiser.optimiser import Optimiser
 
+# pngcrush options for each level: a single method, pngcrush's default handful
+# of methods, or every filter/zlib combination
+PNGCRUSH_OPTIONS = {
+    'fast': '-m 1 ',
+    'balanced': '',
+    'max': '-brute '
+}
+
+def pngcrush_command(level='max', quiet=False):
+    """
+    Returns the pngcrush command for an optimisation level
+    """
+    return 'pngcrush -rem alla %s-reduce %s"__INPUT__" "__OUTPUT__"' % (
+        PNGCRUSH_OPTIONS[level], '-q ' if quiet else '')
+
 class OptimisePNG(Optimiser):
     """
     Optimises pngs. Uses pngnq (http://pngnq.sourceforge.net/) to quantise them, then uses pngcrush
@@ -11,10 +26,7 @@ class OptimisePNG(Optimiser):
     def __init__(self, **kwargs):
         super(OptimisePNG, self).__init__(**kwargs)
 
-        if kwargs.get('quiet') == True:
-            pngcrush = 'pngcrush -rem alla -brute -reduce -q "__INPUT__" "__OUTPUT__"'
-        else:
-            pngcrush = 'pngcrush -rem alla -brute -reduce "__INPUT__" "__OUTPUT__"'
+        pngcrush = pngcrush_command(self.level, kwargs.get('quiet') == True)
 
         # the command to execute this optimiser
         self.commands = ('pngnq -n 256 -o "__OUTPUT__" "__INPUT__"', pngcrush)
@@ -1,12 +1,19 @@
 import os.path
 import os
+import collections
 import shlex
 import subprocess
 import sys
 import shutil
 import logging
 import tempfile
-from scratch import Scratch
+import threading
+import time
+from capture import Capture
+from identify import identify
+
+# os.replace is only in Python 3; os.rename is just as atomic on POSIX
+_replace = getattr(os, 'replace', os.rename)
 
 class Optimiser(object):
     """
@@ -19,6 +26,16 @@ class Optimiser(object):
     # string to place between the basename and extension of output images
     output_suffix = "-opt.smush"
 
+    # speed/size presets, from quickest to smallest output
+    levels = ('fast', 'balanced', 'max')
+
+    # whether the commands are alternatives to run at the same time, keeping the smallest
+    # output, rather than stages to apply one after another
+    race = False
+
+    # bytes of each command's stdout and stderr kept in memory
+    capture_limit = 65536
+
 
     def __init__(self, **kwargs):
         # the number of times the _get_command iterator has been run
@@ -28,17 +45,26 @@ class Optimiser(object):
         self.bytes_saved = 0
         self.list_only = kwargs.get('list_only')
         self.array_optimised_file = []
+        # the number of files won by each command, when racing commands
+        self.winners = {}
         self.quiet = kwargs.get('quiet')
-        self.stdout = Scratch()
-        self.stderr = Scratch()
-
-    def __del__(self):
-        self.stdout.destruct()
-        self.stderr.destruct()
+        self.level = kwargs.get('level') or 'max'
+        # seconds allowed for optimising each file. once used up, the best
+        # result so far is kept
+        self.time_budget = kwargs.get('time_budget')
+        # whether the time budget ran out before the last file was fully optimised
+        self.timed_out = False
+        # (command, exit code, stderr) of the most recent commands, for diagnosing failures
+        self.diagnostics = collections.deque(maxlen=kwargs.get('diagnostics') or 20)
 
-    def set_input(self, input):
+    def set_input(self, input, format=None):
+        """
+        Sets the file to optimise. 'format' is the image format as returned by
+        identify(), if the caller already knows it.
+        """
         self.iterations = 0
         self.input = input
+        self.input_format = format
 
 
     def _get_command(self):
@@ -56,9 +82,15 @@ class Optimiser(object):
 
     def _get_output_file_name(self):
         """
-        Returns the input file name with Optimiser.output_suffix inserted before the extension
+        Returns the name of a scratch file ending in Optimiser.output_suffix. It's in the
+        directory of the file the input resolves to where possible, so the input can be replaced
+        by renaming it.
         """
-        temp = tempfile.mkstemp(suffix=Optimiser.output_suffix)
+        try:
+            temp = tempfile.mkstemp(suffix=Optimiser.output_suffix, prefix='.smush-',
+                                    dir=os.path.dirname(os.path.realpath(self.input)))
+        except OSError:
+            temp = tempfile.mkstemp(suffix=Optimiser.output_suffix)
         try:
             output_file_name = temp[1]
             os.unlink(output_file_name)
@@ -76,24 +108,23 @@ class Optimiser(object):
 
     def _keep_smallest_file(self, input, output):
         """
-        Compares the sizes of two files, and discards the larger one
+        Compares the sizes of the best file so far and a command's output, and discards the
+        larger one. The original input file is never discarded. Returns whether the output was
+        kept.
         """
         input_size = os.path.getsize(input)
         output_size = os.path.getsize(output)
 
-        # if the image was optimised (output is smaller than input), overwrite the input file with the output
-        # file.
+        # if the image was optimised (output is smaller than input), the output becomes the file
+        # to beat
         if (output_size > 0 and output_size < input_size):
-            try:
-                shutil.copyfile(output, input)
-                self.files_optimised += 1
-                self.bytes_saved += (input_size - output_size)
-            except IOError:
-                logging.error("Unable to copy %s to %s: %s" % (output, input, IOError))
-                sys.exit(1)
-        
+            if input != self.input:
+                os.unlink(input)
+            return True
+
         # delete the output file
         os.unlink(output)
+        return False
         
 
     def _is_acceptable_image(self, input):
@@ -103,25 +134,13 @@ class Optimiser(object):
         All optimisers are expected to define a variable called 'format' containing the file format
         as returned by 'identify -format %m'
         """
-        test_command = 'identify -format %%m "%s"' % input
-        args = shlex.split(test_command)
-
-        try:
-            retcode = subprocess.call(args, stdout=self.stdout.opened, stderr=self.stderr.opened)
-        except OSError:
-            logging.error("Error executing command %s. Error was %s" % (test_command, OSError))
-            sys.exit(1)
-        except:
-            # most likely no file matched
+        if self.input_format is None:
+            self.input_format = identify(input)
+        if not self.input_format:
             if self.quiet == False:
                 logging.warning("Cannot identify file.")
             return False
-        if retcode != 0:
-            if self.quiet == False:
-                logging.warning("Cannot identify file.")
-            return False
-        output = self.stdout.read().strip()
-        return output.startswith(self.format)
+        return self.input_format.startswith(self.format)
 
 
     def optimise(self):
@@ -129,6 +148,8 @@ class Optimiser(object):
         Calls the 'optimise_image' method on the object. Tests the 'optimised' file size. If the
         generated file is larger than the original file, discard it, otherwise discard the input file.
         """
+        self.timed_out = False
+
         # make sure the input image is acceptable for this optimiser
         if not self._is_acceptable_image(self.input):
             logging.warning("%s is not a valid image for this optimiser" % (self.input))
@@ -136,45 +157,213 @@ class Optimiser(object):
 
         self.files_scanned += 1
 
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.time() + self.time_budget
+
+        if self.race:
+            optimised = self.__race(deadline)
+        else:
+            optimised = self.__chain(deadline)
+        self.timed_out = deadline is not None and time.time() >= deadline
+
+        if optimised:
+            self.files_optimised += 1
+            if self.list_only:
+                self.array_optimised_file.append(self.input)
+
+
+    def __chain(self, deadline=None):
+        """
+        Applies each command in turn to the best file so far, so every stage builds on the
+        savings of the one before. The input is replaced once, at the end. Returns whether any
+        command made the file smaller.
+        """
+        best = self.input
+
         while True:
+            if deadline is not None and time.time() >= deadline:
+                logging.info("Time budget used up for %s, keeping the best result so far" % (self.input))
+                break
+
             command = self._get_command()
 
             if not command:
                 break
 
             output_file_name = self._get_output_file_name()
-            command = self.__replace_placeholders(command, self.input, output_file_name)
+            command = self.__replace_placeholders(command, best, output_file_name)
             logging.info("Executing %s" % (command))
             args = shlex.split(command)
             
             try:
-                retcode = subprocess.call(args, stdout=self.stdout.opened, stderr=self.stderr.opened)
+                retcode = self._wait(self._start(args), deadline)
             except OSError:
                 logging.error("Error executing command %s. Error was %s" % (command, OSError))
                 sys.exit(1)
 
             if retcode != 0:
                 # gifsicle seems to fail by the file size?
+                if os.path.exists(output_file_name):
+                    os.unlink(output_file_name)
+            elif self._keep_smallest_file(best, output_file_name):
+                best = output_file_name
+
+        return self.__commit(best)
+
+
+    def __race(self, deadline=None):
+        """
+        Runs every command on the input at once, each writing its own output file, and once
+        they have all finished (or 'deadline' has passed) keeps the smallest output. Returns
+        whether it was smaller than the input.
+        """
+        candidates = []
+        for template in self.commands:
+            output_file_name = self._get_output_file_name()
+            command = self.__replace_placeholders(template, self.input, output_file_name)
+            logging.info("Executing %s" % (command))
+            try:
+                process = self._start(shlex.split(command))
+            except OSError:
+                logging.error("Error executing command %s. Error was %s" % (command, OSError))
+                sys.exit(1)
+            candidates.append((template, process, output_file_name))
+
+        winner = None
+        winner_size = None
+        for template, process, output_file_name in candidates:
+            if self._wait(process, deadline) == 0 and os.path.exists(output_file_name):
+                size = os.path.getsize(output_file_name)
+                if size > 0 and (winner is None or size < winner_size):
+                    winner, winner_size = (template, output_file_name), size
+
+        for template, process, output_file_name in candidates:
+            if (winner is None or output_file_name != winner[1]) and os.path.exists(output_file_name):
                 os.unlink(output_file_name)
-            else :
-                if self.list_only == False:
-                    # compare file sizes if the command executed successfully
-                    self._keep_smallest_file(self.input, output_file_name)
-                else:
-                    self._list_only(self.input, output_file_name)
 
+        if winner is None:
+            return False
+
+        template, output_file_name = winner
+        if not self._keep_smallest_file(self.input, output_file_name):
+            return False
+
+        self.winners[template] = self.winners.get(template, 0) + 1
+        return self.__commit(output_file_name)
 
-    def _list_only(self, input, output):
+
+    def __commit(self, best):
         """
-        Always keeps input, but still compares the sizes of two files
+        Replaces the input with the best output found, unless listing only. Returns whether the
+        input was optimised.
+
+        The output is renamed over the input, keeping the input's permissions, so anything
+        reading the input at the same time sees either the old image or the new one. If the
+        input is a symlink the file it points to is replaced, so the link survives.
         """
-        input_size = os.path.getsize(input)
-        output_size = os.path.getsize(output)
+        if best == self.input:
+            return False
 
-        if (output_size > 0 and output_size < input_size):
-            self.files_optimised += 1
-            self.bytes_saved += (input_size - output_size)
-            self.array_optimised_file.append(input)
-        
-        # delete the output file
-        os.unlink(output)
+        self.bytes_saved += os.path.getsize(self.input) - os.path.getsize(best)
+        if self.list_only:
+            os.unlink(best)
+            return True
+
+        target = os.path.realpath(self.input)
+        try:
+            shutil.copymode(target, best)
+            _replace(best, target)
+        except OSError:
+            # the scratch file is on another filesystem
+            try:
+                copy_file(best, target)
+            except (IOError, OSError), e:
+                logging.error("Unable to copy %s to %s: %s" % (best, target, e))
+                sys.exit(1)
+            os.unlink(best)
+        return True
+
+
+    def _start(self, args):
+        """
+        Starts a command, capturing its output in memory
+        """
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.command = args[0]
+        process.stdout_capture = Capture(process.stdout, self.capture_limit)
+        process.stderr_capture = Capture(process.stderr, self.capture_limit)
+        return process
+
+
+    def _wait(self, process, deadline=None):
+        """
+        Waits for a command to finish and returns its exit code. If it's still running at
+        'deadline' it is killed.
+        """
+        timer = None
+        if deadline is not None:
+            timer = threading.Timer(max(0, deadline - time.time()), _kill, (process,))
+            timer.start()
+        try:
+            retcode = process.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        # a killed command's own children may still hold its pipes open, so don't wait long
+        # for them to close
+        if retcode < 0:
+            until = time.time() + 1
+            process.stdout_capture.read(1)
+            stderr = process.stderr_capture.read(max(0, until - time.time()))
+        else:
+            process.stdout_capture.read()
+            stderr = process.stderr_capture.read()
+        self.diagnostics.append((process.command, retcode, stderr))
+        if retcode != 0:
+            logging.debug("%s exited with %s: %s" % (process.command, retcode, stderr.strip()))
+        return retcode
+
+
+def copy_file(source, target, link=False):
+    """
+    Replaces 'target' with a copy of 'source', keeping the permissions of 'target', or with
+    'link' a hardlink to it where possible. The copy is made in a scratch file beside the file
+    'target' resolves to and renamed over it, so anything reading 'target' sees either the old
+    file or the new one. Raises IOError or OSError if it can't be replaced.
+    """
+    target = os.path.realpath(target)
+    if os.path.exists(target) and os.path.samefile(source, target):
+        # e.g. a symlink to the source, or a hardlink made by an earlier run
+        return
+    fd, temp = tempfile.mkstemp(suffix=Optimiser.output_suffix, prefix='.smush-',
+                                dir=os.path.dirname(target))
+    os.close(fd)
+    try:
+        linked = False
+        if link:
+            os.unlink(temp)
+            try:
+                os.link(source, temp)
+                linked = True
+            except OSError:
+                # on another filesystem, or links aren't supported
+                pass
+        if not linked:
+            shutil.copyfile(source, temp)
+            shutil.copymode(target, temp)
+        _replace(temp, target)
+    finally:
+        # left behind if anything failed, or if the rename was a no-op
+        # because temp and target were already links to the same file
+        if os.path.exists(temp):
+            os.unlink(temp)
+
+
+def _kill(process):
+    try:
+        process.kill()
+    except OSError:
+        # already finished
+        pass
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 
-import sys, os, os.path, getopt, time, shlex, subprocess, logging
-from subprocess import CalledProcessError
+import sys, os, os.path, getopt, time, logging, multiprocessing
+from optimiser.optimiser import Optimiser, copy_file
 from optimiser.formats.png import OptimisePNG
 from optimiser.formats.jpg import OptimiseJPG
 from optimiser.formats.gif import OptimiseGIF
 from optimiser.formats.animated_gif import OptimiseAnimatedGIF
-from scratch import Scratch
+from identify import identify
+from manifest import Manifest, hash_file
+from walk import walk_files
 
 __author__     = 'al, Takashi Mizohata'
 __credit__     = ['al', 'Takashi Mizohata']
@@ -25,103 +27,248 @@ class Smush():
 
         self.__files_scanned = 0
         self.__start_time = time.time()
-        self.exclude = {}
-        for dir in kwargs.get('exclude'):
-            if len(dir) == 0:
-                continue
-            self.exclude[dir] = True
+        # glob patterns matched against file and directory names
+        self.exclude = [pattern for pattern in kwargs.get('exclude') if len(pattern) != 0]
+        # scratch files of optimisers running on the same directory
+        self.exclude.append('*' + Optimiser.output_suffix)
+        # file extensions to optimise, or None for any
+        self.extensions = kwargs.get('extensions')
         self.quiet = kwargs.get('quiet')
         self.identify_mime = kwargs.get('identify_mime')
 
-        # setup tempfile for stdout and stderr
-        self.stdout = Scratch()
-        self.stderr = Scratch()
+        # number of worker processes to optimise files with. 1 optimises
+        # files one after another in this process
+        self.jobs = kwargs.get('jobs') or 1
+        self.kwargs = kwargs
+
+        # how to give byte-identical files the optimised version of the first of them: 'copy'
+        # or 'link' (hardlink). None optimises each file separately
+        self.dedup = kwargs.get('dedup')
 
-    def __del__(self):
-        self.stdout.destruct()
-        self.stderr.destruct()
+        # record of files processed by earlier runs, which are skipped
+        # until they change
+        self.list_only = kwargs.get('list_only')
+        self.level = kwargs.get('level') or 'max'
+        self.manifest = None
+        if kwargs.get('manifest'):
+            self.manifest = Manifest(kwargs.get('manifest'))
 
     def __smush(self, file):
         """
         Optimises a file
         """
+        if self.__is_unchanged(file):
+            return None
+
         key = self.__get_image_format(file)
 
         if key in self.optimisers:
             logging.info('optimising file %s' % (file))
             self.__files_scanned += 1
-            self.optimisers[key].set_input(file)
-            self.optimisers[key].optimise()
+            optimiser = self.optimisers[key]
+            bytes_saved = optimiser.bytes_saved
+            optimiser.set_input(file, key)
+            optimiser.optimise()
+            self.__record(file, optimiser.bytes_saved - bytes_saved, not optimiser.timed_out)
+
+        return key
+
+
+    def __is_unchanged(self, file):
+        """
+        Returns whether the manifest shows a file hasn't changed since it was
+        last processed at this level or a stronger one
+        """
+        if self.manifest is not None and self.manifest.is_unchanged(file, self.level):
+            logging.info('%s is unchanged since the last run.' % (file))
+            return True
+        return False
+
+
+    def __record(self, file, bytes_saved, complete=True):
+        if self.manifest is not None and not self.list_only:
+            self.manifest.record(file, bytes_saved, self.level, complete)
+
+
+    def _smush_counted(self, file):
+        """
+        Optimises a file and returns the change in the counters of the optimiser
+        that handled it, so results from worker processes can be merged back
+        into the parent Smush with _merge_counts.
+        """
+        before = dict((key, (optimiser.files_scanned, optimiser.files_optimised,
+                             optimiser.bytes_saved, len(optimiser.array_optimised_file),
+                             dict(optimiser.winners)))
+                      for key, optimiser in self.optimisers.iteritems())
+
+        key = self.__smush(file)
+        if key not in self.optimisers:
+            return None
+
+        optimiser = self.optimisers[key]
+        scanned, optimised, saved, modified, winners = before[key]
+        return (file, key,
+                optimiser.files_scanned - scanned,
+                optimiser.files_optimised - optimised,
+                optimiser.bytes_saved - saved,
+                optimiser.array_optimised_file[modified:],
+                dict((command, count - winners.get(command, 0))
+                     for command, count in optimiser.winners.iteritems()
+                     if count != winners.get(command, 0)),
+                not optimiser.timed_out)
+
+
+    def _merge_counts(self, counts):
+        """
+        Adds the counters returned by _smush_counted to this Smush's optimisers
+        """
+        if counts is None:
+            return
+
+        file, key, scanned, optimised, saved, modified, winners, complete = counts
+        optimiser = self.optimisers[key]
+        optimiser.files_scanned += scanned
+        optimiser.files_optimised += optimised
+        optimiser.bytes_saved += saved
+        optimiser.array_optimised_file.extend(modified)
+        for command, count in winners.iteritems():
+            optimiser.winners[command] = optimiser.winners.get(command, 0) + count
+        self.__files_scanned += 1
+        self.__record(file, saved, complete)
+
+
+    def __smush_parallel(self, files, callback=None):
+        """
+        Optimises files in a pool of self.jobs worker processes, merging the
+        per-file counters of each worker into this Smush's optimisers. The
+        counters are also passed to 'callback', if given.
+        """
+        # only this process writes to the manifest
+        kwargs = dict(self.kwargs, jobs=1, manifest=None)
+        pool = multiprocessing.Pool(self.jobs, _init_worker, (kwargs,))
+        try:
+            for counts in pool.imap_unordered(_smush_worker, files, chunksize=16):
+                self._merge_counts(counts)
+                if callback is not None:
+                    callback(counts)
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
 
     def process(self, dir, recursive):
         """
-        Iterates through the input directory optimising files
+        Iterates through the input directory optimising files as they're found
+        """
+        files = walk_files(dir, recursive, self.exclude, self.extensions, self.identify_mime)
+        if self.dedup:
+            self.__process_deduped(files)
+        elif self.jobs > 1:
+            self.__smush_parallel(file for file in files if not self.__is_unchanged(file))
+        else:
+            for file in files:
+                self.__smush(file)
+
+        if self.manifest is not None:
+            self.manifest.commit()
+
+
+    def __process_deduped(self, files):
+        """
+        Optimises one file of each set of byte-identical files, then gives the rest of the set
+        the result
         """
-        if recursive:
-            self.__walk(dir, self.__smush)
+        representatives, duplicates = self.__find_duplicates(
+            [file for file in files if not self.__is_unchanged(file)])
+
+        def apply(counts):
+            if counts is not None and counts[0] in duplicates:
+                self.__apply_to_duplicates(counts, duplicates[counts[0]])
+
+        if self.jobs > 1:
+            self.__smush_parallel(representatives, apply)
         else:
-            if os.path.isdir(dir):
-                dir = os.path.abspath(dir)
-                for file in os.listdir(dir):
-                    if self.__checkExclude(file):
-                        continue
-                        
-                    if self.identify_mime:
-                        import mimetypes
-                        (type,encoding) = mimetypes.guess_type(file)
-                        if type and (type[:5] != "image"):
-                            continue
-
-                    self.__smush(os.path.join(dir, file))
-            elif os.path.isfile(dir):
-                self.__smush(dir)
-
-
-    def __walk(self, dir, callback):
-        """ Walks a directory, and executes a callback on each file """
-        dir = os.path.abspath(dir)
-        logging.info('walking %s' % (dir))
-        for file in os.listdir(dir):
-            if self.__checkExclude(file):
+            for file in representatives:
+                apply(self._smush_counted(file))
+
+
+    def __find_duplicates(self, files):
+        """
+        Groups byte-identical files, first by size and then, for sizes shared by several files,
+        by content hash. Returns the first file of each group, in the order given, and a dict
+        of each of those to the rest of its group.
+        """
+        order = {}
+        by_size = {}
+        for file in files:
+            try:
+                size = os.path.getsize(file)
+            except OSError:
+                continue
+            order[file] = len(order)
+            by_size.setdefault(size, []).append(file)
+
+        representatives = []
+        duplicates = {}
+        for group in by_size.itervalues():
+            if len(group) == 1:
+                representatives.extend(group)
                 continue
-            
-            if self.identify_mime:
-                import mimetypes
-                (type,encoding) = mimetypes.guess_type(file)        
-                if type and (type[:5] != "image"):
-                    continue
 
-            nfile = os.path.join(dir, file)
-            callback(nfile)
-            if os.path.isdir(nfile):
-                self.__walk(nfile, callback)
+            by_hash = {}
+            for file in group:
+                by_hash.setdefault(hash_file(file), []).append(file)
+            for same in by_hash.itervalues():
+                representatives.append(same[0])
+                if len(same) > 1:
+                    logging.info('%s has %d duplicates' % (same[0], len(same) - 1))
+                    duplicates[same[0]] = same[1:]
 
+        representatives.sort(key=order.get)
+        return representatives, duplicates
 
-    def __get_image_format(self, input):
+
+    def __apply_to_duplicates(self, counts, duplicates):
         """
-        Returns the image format for a file.
+        Replaces each duplicate of an optimised file with it, and counts them as optimised by the
+        same optimiser
         """
-        test_command = 'identify -format %%m "%s"' % input
-        args = shlex.split(test_command)
+        file, key, scanned, optimised, saved, modified, winners, complete = counts
+        optimiser = self.optimisers[key]
+        for duplicate in duplicates:
+            if optimised and not self.list_only:
+                self.__replace_duplicate(file, duplicate)
+            logging.info('%s is a duplicate of %s' % (duplicate, file))
+            optimiser.files_scanned += scanned
+            optimiser.files_optimised += optimised
+            optimiser.bytes_saved += saved
+            if modified:
+                optimiser.array_optimised_file.append(duplicate)
+            self.__files_scanned += 1
+            self.__record(duplicate, saved, complete)
+
 
+    def __replace_duplicate(self, source, target):
+        """
+        Replaces 'target' with a hardlink to or copy of 'source' (as set by self.dedup)
+        """
         try:
-            retcode = subprocess.call(args, stdout=self.stdout.opened, stderr=self.stderr.opened)
-            if retcode != 0:
-                if self.quiet == False:
-                    logging.warning(self.stderr.read().strip())
-                return False
+            copy_file(source, target, link=(self.dedup == 'link'))
+        except (IOError, OSError), e:
+            logging.error('Unable to replace %s with %s: %s' % (target, source, e))
 
-        except OSError:
-            logging.error('Error executing command %s. Error was %s' % (test_command, OSError))
-            sys.exit(1)
-        except:
-            # most likely no file matched
-            if self.quiet == False:
-                logging.warning('Cannot identify file.')
-            return False
 
-        return self.stdout.read().strip()[:6]
+    def __get_image_format(self, input):
+        """
+        Returns the image format for a file.
+        """
+        format = identify(input)
+        if not format and self.quiet == False and os.path.isfile(input):
+            logging.warning('Cannot identify file %s.' % (input))
+        return format
 
 
     def stats(self):
@@ -130,13 +277,13 @@ class Smush():
         arr = []
 
         for key, optimiser in self.optimisers.iteritems():
-            # divide optimiser.files_optimised by 2 for each optimiser since each optimised file
-            # gets counted twice
             output.append('    %d %ss optimised out of %d scanned. Saved %dkb' % (
-                    optimiser.files_optimised // 2,
+                    optimiser.files_optimised,
                     key, 
                     optimiser.files_scanned, 
                     optimiser.bytes_saved / 1024))
+            for command, count in sorted(optimiser.winners.iteritems()):
+                output.append('        %d won by %s' % (count, command))
             arr.extend(optimiser.array_optimised_file)
 
         if (len(arr) != 0):
@@ -147,16 +294,20 @@ class Smush():
         return {'output': "\n".join(output), 'modified': arr}
 
 
-    def __checkExclude(self, file):
-        if file in self.exclude:
-            logging.info('%s is excluded.' % (file))
-            return True
-        return False
+# the Smush instance used by each process in a Smush.jobs worker pool
+_worker = None
+
+def _init_worker(kwargs):
+    global _worker
+    _worker = Smush(**kwargs)
+
+def _smush_worker(file):
+    return _worker._smush_counted(file)
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hrqs', ['help', 'recursive', 'quiet', 'strip-meta', 'exclude=', 'list-only' ,'identify-mime'])
+        opts, args = getopt.getopt(sys.argv[1:], 'hrqsj:', ['help', 'recursive', 'quiet', 'strip-meta', 'exclude=', 'list-only' ,'identify-mime', 'jobs=', 'manifest=', 'level=', 'time-budget=', 'extensions=', 'dedup='])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -171,6 +322,12 @@ def main():
     exclude = ['.bzr', '.git', '.hg', '.svn']
     list_only = False
     identify_mime = False
+    jobs = 1
+    manifest = None
+    level = 'max'
+    time_budget = None
+    extensions = None
+    dedup = None
 
     for opt, arg in opts:
         if opt in ('-h', '--help'):
@@ -189,6 +346,34 @@ def main():
         elif opt in ('--list-only'):
             list_only = True
             # quiet = True
+        elif opt in ('-j', '--jobs'):
+            try:
+                jobs = int(arg)
+            except ValueError:
+                usage()
+                sys.exit(2)
+            if jobs < 1:
+                jobs = multiprocessing.cpu_count()
+        elif opt in ('--manifest'):
+            manifest = arg
+        elif opt in ('--level'):
+            level = arg
+            if level not in OptimisePNG.levels:
+                usage()
+                sys.exit(2)
+        elif opt in ('--time-budget'):
+            try:
+                time_budget = float(arg)
+            except ValueError:
+                usage()
+                sys.exit(2)
+        elif opt in ('--extensions'):
+            extensions = [ext for ext in arg.strip().split(',') if ext]
+        elif opt in ('--dedup'):
+            dedup = arg
+            if dedup not in ('copy', 'link'):
+                usage()
+                sys.exit(2)
         else:
             # unsupported option given
             usage()
@@ -205,7 +390,9 @@ def main():
             format='%(asctime)s %(levelname)s %(message)s',
             datefmt='%Y-%m-%d %H:%M:%S')
 
-    smush = Smush(strip_jpg_meta=strip_jpg_meta, exclude=exclude, list_only=list_only, quiet=quiet, identify_mime=identify_mime)
+    smush = Smush(strip_jpg_meta=strip_jpg_meta, exclude=exclude, list_only=list_only, quiet=quiet, identify_mime=identify_mime, jobs=jobs, manifest=manifest,
+                  level=level, time_budget=time_budget, extensions=extensions,
+                  dedup=dedup)
 
     for arg in args:
         try:
@@ -237,9 +424,23 @@ on the web.
   -r, --recursive    Recurse through given directories optimising images
   -q, --quiet        Don't display optimisation statistics at the end
   -s, --strip-meta   Strip all meta-data from JPEGs
-  --exclude=EXCLUDES comma separated value for excluding files
+  --exclude=EXCLUDES comma separated glob patterns for excluding files and
+                     directories, e.g. '*.min.png,thumbs'
+  --extensions=EXTS  comma separated file extensions to optimise, e.g.
+                     'png,jpg,gif' (default all files)
   --identify-mime    Fast identify image files via mimetype
   --list-only        Perform a trial run with no changes made
+  -j, --jobs=N       Optimise N files at a time in worker processes
+                     (0 uses one worker per CPU)
+  --manifest=FILE    Record processed files in FILE and skip them on later
+                     runs until they change, unless the later run uses a
+                     stronger --level or the time budget ran out on them
+  --level=LEVEL      fast, balanced or max (default): how hard to try to
+                     shrink each file
+  --time-budget=SECS Stop optimising a file after SECS seconds, keeping the
+                     best result so far
+  --dedup=MODE       Optimise byte-identical files once, and copy (copy) or
+                     hardlink (link) the result over the others
 """
 
 if __name__ == '__main__':
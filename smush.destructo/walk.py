@@ -0,0 +1,91 @@
+import os, os.path, stat, fnmatch, mimetypes, logging
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def walk_files(path, recursive=False, exclude=(), extensions=None, identify_mime=False):
+    """
+    Yields the files to optimise under 'path' (or 'path' itself, if it's a file), one at a time
+    so they can be optimised while the tree is still being read.
+
+    Entries whose name matches one of the glob patterns in 'exclude' are skipped, as are
+    directories below 'path' unless 'recursive'. If 'extensions' is given, only files with one of
+    those extensions are yielded. With 'identify_mime', files whose mimetype isn't an image type
+    are skipped.
+
+    Directories are read with scandir where available (Python 3.5+, or the scandir package),
+    which tells files from directories without a stat call per entry, otherwise with a single
+    stat per entry; they're walked with a stack rather than recursion so deep trees
+    can't hit the recursion limit.
+    """
+    if os.path.isfile(path):
+        yield path
+        return
+    if not os.path.isdir(path):
+        return
+
+    if extensions is not None:
+        extensions = set('.' + ext.lower().lstrip('.') for ext in extensions)
+
+    stack = [os.path.abspath(path)]
+    while stack:
+        dir = stack.pop()
+        logging.info('walking %s' % (dir))
+        for name, full_path, is_dir, is_file in _list(dir):
+            if _is_excluded(name, exclude):
+                logging.info('%s is excluded.' % (name))
+                continue
+
+            if is_dir:
+                if recursive:
+                    stack.append(full_path)
+                continue
+
+            if not is_file:
+                continue
+
+            if extensions is not None and os.path.splitext(name)[1].lower() not in extensions:
+                continue
+
+            if identify_mime:
+                (type, encoding) = mimetypes.guess_type(name)
+                if type and (type[:5] != "image"):
+                    continue
+
+            yield full_path
+
+
+def _is_excluded(name, exclude):
+    for pattern in exclude:
+        if name == pattern or fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def _list(dir):
+    """
+    Yields (name, path, is_dir, is_file) for each entry in a directory
+    """
+    try:
+        if scandir is not None:
+            for entry in scandir(dir):
+                yield entry.name, entry.path, entry.is_dir(), entry.is_file()
+        else:
+            for name in os.listdir(dir):
+                full_path = os.path.join(dir, name)
+                # one stat per entry, rather than one each for isdir and isfile
+                try:
+                    mode = os.stat(full_path).st_mode
+                except OSError:
+                    # e.g. a broken symlink, which is neither
+                    yield name, full_path, False, False
+                    continue
+                yield name, full_path, stat.S_ISDIR(mode), stat.S_ISREG(mode)
+    except OSError, e:
+        logging.warning('Cannot read directory %s: %s' % (dir, e))